@@ -1,36 +1,223 @@
 import os
+import time
 import json
 import uuid
 import hmac
 import hashlib
 import base64
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+import io
+import csv
+import gzip
+import atexit
+import logging
+import threading
+from collections import Counter
+from datetime import date, datetime, timedelta
+import click
+from flask import Flask, request, jsonify, g, render_template
 from flask_cors import CORS
 import gspread
 from google.oauth2.service_account import Credentials
+from wc_payload import (FORMAT_FORM, FORMAT_MULTIPART, FORMAT_JSON, compute_sigs, verify_sig,
+                        detect_format, parse_form, form_to_data, decode_json, is_ping, ACCEPTED_STATUSES,
+                        parse_datetime_iso, order_status, normalize_order, order_hash)
+import metrics
+import backfill
+from logs import setup_logging, kv, payload_preview
+from storage import (SHEET_COLUMNS, SheetStorage, SqliteStorage, PartitionedSheetStorage, RowSpool, OrderDedup,
+                     LRUCache, SheetsGateway, SheetsUnavailable, PartitionArchived, LazySheet, row_to_record, partition_key,
+                     partition_title, tracking_id_from_link, link_column)
+
+# brotli for compressed responses when installed, gzip otherwise
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Cold-start timing, reported by /ready
+BOOT_STARTED = time.monotonic()
 
 # ---------- Config Flask ----------
 app = Flask(__name__)
 CORS(app)
 
-# ---------- Google Sheets (creds via env) ----------
-creds_env = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON")
-if not creds_env:
-    raise Exception("GOOGLE_APPLICATION_CREDENTIALS_JSON missing in environment")
-
-try:
-    creds_dict = json.loads(creds_env)
-except Exception as e:
-    raise Exception("Error parsing GOOGLE_APPLICATION_CREDENTIALS_JSON: " + str(e))
+# ---------- Logging (JSON lines, written by a background thread) ----------
+setup_logging()
+log = logging.getLogger("tracking")
 
+# ---------- Google Sheets (creds via env) ----------
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-gc = gspread.authorize(creds)
 
 # Put your Google Sheet ID here (the /d/<ID>/ part)
 SHEET_ID = "16v-pieF7pQt7GMoTnjknCV0XkWAlgDzLZs9SCycNSXI"
-sheet = gc.open_by_key(SHEET_ID).sheet1
+SHEETS_HTTP_TIMEOUT = float(os.environ.get("SHEETS_HTTP_TIMEOUT", "30"))
+
+def open_spreadsheet():
+    creds_env = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON")
+    if not creds_env:
+        raise Exception("GOOGLE_APPLICATION_CREDENTIALS_JSON missing in environment")
+
+    try:
+        creds_dict = json.loads(creds_env)
+    except Exception as e:
+        raise Exception("Error parsing GOOGLE_APPLICATION_CREDENTIALS_JSON: " + str(e))
+
+    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
+    gc = gspread.authorize(creds)
+    # HTTP timeout so a hung call eventually frees its gateway thread too
+    gc.set_timeout(SHEETS_HTTP_TIMEOUT)
+    return gc.open_by_key(SHEET_ID)
+
+def open_worksheet():
+    return open_spreadsheet().sheet1
+
+def open_sheet(whole_spreadsheet=False):
+    # Nothing touches Google here: auth and open_by_key run on first use, through
+    # the gateway (deadlines, bounded pool, circuit breaker)
+    return SheetsGateway(LazySheet(open_spreadsheet if whole_spreadsheet else open_worksheet))
+
+# ---------- Signed tracking tokens ----------
+# When set, new tracking links carry the fields the timeline needs (HMAC-signed),
+# so /api/track can build it without any storage read. The token is only signed,
+# not encrypted: order ID, customer, status and total stay out of it
+# Not available with SHEET_PARTITIONS=month (tokens carry no month prefix)
+TRACKING_TOKEN_SECRET = os.environ.get("TRACKING_TOKEN_SECRET", "")
+TOKEN_SIG_BYTES = 12
+TOKEN_FIELDS = ("Created At", "Service", "Country", "City", "Postcode")
+
+# ---------- Storage ----------
+# "sheet": the Google Sheet is the datastore (default)
+# "sqlite": local SQLite file, the Sheet is only an optional mirror (SHEET_MIRROR)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sheet").lower()
+LOCAL_DB_PATH = os.environ.get("LOCAL_DB_PATH", "tracking.db")
+# sheet backend: journal rows locally and flush them in batches
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "1").lower() in ("1", "true", "yes")
+# sqlite backend: copy new rows to the Google Sheet in the background
+SHEET_MIRROR = os.environ.get("SHEET_MIRROR", "1").lower() in ("1", "true", "yes")
+# sheet backend: "month" writes each month's orders to its own worksheet (orders-YYYY-MM)
+# and puts the month in the tracking ID; "none" keeps everything in sheet1
+SHEET_PARTITIONS = os.environ.get("SHEET_PARTITIONS", "none").lower()
+# sheet backend (SHEET_PARTITIONS=none): one worker keeps the tracking index and writes it
+# to this file, the others mmap it instead of each holding a copy. Local disk, shared by
+# the workers of one host (status updates are journaled in <path>.db); empty = every
+# worker keeps its own index, sharing status updates through LOCAL_DB_PATH
+TRACK_SNAPSHOT_PATH = os.environ.get("TRACK_SNAPSHOT_PATH", "")
+
+def init_storage(worksheet=None):
+    """Build the configured backend; worksheet stands in for the Google Sheet (benchmarks).
+
+    With SHEET_PARTITIONS=month it stands in for the whole spreadsheet instead.
+    """
+    global sheet, storage
+    if SHEET_PARTITIONS not in ("none", "month"):
+        raise Exception("Unknown SHEET_PARTITIONS: " + SHEET_PARTITIONS)
+    partitioned = STORAGE_BACKEND == "sheet" and SHEET_PARTITIONS == "month"
+    if partitioned and TRACKING_TOKEN_SECRET:
+        # Signed tokens carry no month prefix, so their rows could not be found in a partition
+        raise Exception("TRACKING_TOKEN_SECRET cannot be used with SHEET_PARTITIONS=month")
+    if worksheet is not None:
+        new_sheet = SheetsGateway(worksheet)
+    elif partitioned:
+        new_sheet = open_sheet(whole_spreadsheet=True)
+    elif STORAGE_BACKEND == "sheet" or (STORAGE_BACKEND == "sqlite" and SHEET_MIRROR):
+        new_sheet = open_sheet()
+    else:
+        new_sheet = None
+
+    if storage is not None:
+        # Re-init (benchmarks): release what the previous backend holds, e.g. the snapshot lock
+        storage.close()
+    spool = RowSpool(LOCAL_DB_PATH) if WRITE_BEHIND and STORAGE_BACKEND == "sheet" else None
+    if STORAGE_BACKEND == "sqlite":
+        new_storage = SqliteStorage(LOCAL_DB_PATH, mirror_sheet=new_sheet)
+    elif partitioned:
+        new_storage = PartitionedSheetStorage(new_sheet, spool=spool, journal_path=LOCAL_DB_PATH)
+    elif STORAGE_BACKEND == "sheet":
+        new_storage = SheetStorage(new_sheet, spool=spool, snapshot_path=TRACK_SNAPSHOT_PATH or None,
+                                   journal_path=LOCAL_DB_PATH)
+    else:
+        raise Exception("Unknown STORAGE_BACKEND: " + STORAGE_BACKEND)
+    sheet, storage = new_sheet, new_storage
+    return storage
+
+sheet = storage = None
+init_storage()
+
+# Repeat deliveries of the same order reuse its tracking ID instead of adding rows
+WEBHOOK_DEDUP = os.environ.get("WEBHOOK_DEDUP", "1").lower() in ("1", "true", "yes")
+order_dedup = OrderDedup(LOCAL_DB_PATH) if WEBHOOK_DEDUP else None
+
+def sheets_unavailable(e):
+    resp = jsonify({"error": "Google Sheet non disponibile, riprova", "detail": str(e)})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+app.register_error_handler(SheetsUnavailable, sheets_unavailable)
+
+@atexit.register
+def _close_storage():
+    try:
+        storage.close()
+    except Exception as e:
+        log.error("closing storage failed", extra=kv(error=repr(e)))
+
+# ---------- Warm-up and readiness ----------
+# Open the Sheet and load the index in the background so the first request finds it ready,
+# retrying with backoff until it is. With SHEETS_WARMUP=0 nothing loads before the first
+# request, so /ready does not wait for the index either
+SHEETS_WARMUP = os.environ.get("SHEETS_WARMUP", "1").lower() in ("1", "true", "yes")
+SHEETS_WARMUP_MAX_BACKOFF = float(os.environ.get("SHEETS_WARMUP_MAX_BACKOFF", "60"))
+boot_times = {"import_ms": None, "warmup_ms": None, "first_response_ms": None}
+
+def _warm_up():
+    started = time.monotonic()
+    delay = 1.0
+    while not storage.is_ready():
+        try:
+            storage.warm_up()
+        except Exception as e:
+            log.warning("warm-up failed, retrying", extra=kv(error=repr(e), retry_in=delay))
+        else:
+            if storage.is_ready():
+                break
+        time.sleep(delay)
+        delay = min(delay * 2, SHEETS_WARMUP_MAX_BACKOFF)
+    boot_times["warmup_ms"] = round((time.monotonic() - started) * 1000, 1)
+    log.info("warm-up done", extra=kv(warmup_ms=boot_times["warmup_ms"]))
+
+if SHEETS_WARMUP:
+    threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+# ---------- Metrics ----------
+# METRICS_ENABLED lives in metrics.py: storage counts through the same switch
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _observe_latency(resp):
+    started = g.get("request_started")
+    if started is not None and metrics.METRICS_ENABLED:
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - started,
+                        endpoint=request.endpoint or "unmatched", status=str(resp.status_code // 100) + "xx")
+    return resp
+
+if metrics.METRICS_ENABLED:
+    metrics.start_snapshots()
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if not metrics.METRICS_ENABLED:
+        return jsonify({"error": "Metrics disabled"}), 404
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.after_request
+def _record_first_response(resp):
+    if boot_times["first_response_ms"] is None:
+        boot_times["first_response_ms"] = round((time.monotonic() - BOOT_STARTED) * 1000, 1)
+        log.info("first response", extra=kv(ms_after_import=boot_times["first_response_ms"]))
+    return resp
 
 # ---------- Webhook secret and debug ----------
 WC_SECRET = os.environ.get("WC_WEBHOOK_SECRET", "")
@@ -40,43 +227,62 @@ DEBUG_SIG = os.environ.get("DEBUG_WC_SIG", "").lower() in ("1", "true", "yes")
 def now_utc():
     return datetime.utcnow()
 
-def parse_datetime_iso(s):
-    if not s:
-        return None
-    try:
-        s2 = s.rstrip("Z")
-        return datetime.fromisoformat(s2)
-    except Exception:
-        for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f"):
-            try:
-                from datetime import datetime as dt
-                return dt.strptime(s, fmt)
-            except Exception:
-                continue
-    return None
-
 def make_tracking_link(uid):
     return "https://tracking-backend-tb40.onrender.com/track/{}".format(uid)
 
-def compute_sigs(secret, payload_bytes):
-    digest = hmac.new(secret.encode("utf-8"), payload_bytes, hashlib.sha256).digest()
-    b64 = base64.b64encode(digest).decode()
-    hexs = digest.hex()
-    return b64, hexs
+def b64url_encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+def b64url_decode(s):
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+def sign_token(secret, body_bytes):
+    return hmac.new(secret.encode("utf-8"), body_bytes, hashlib.sha256).digest()[:TOKEN_SIG_BYTES]
 
-def verify_sig(secret, payload_bytes, header_sig):
-    if not secret:
-        return True
+def make_tracking_token(secret, row):
+    # row is a Sheet row (SHEET_COLUMNS order); only TOKEN_FIELDS go in
+    fields = [str(row[SHEET_COLUMNS.index(name)]) for name in TOKEN_FIELDS]
+    body = json.dumps(fields, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return b64url_encode(body) + "." + b64url_encode(sign_token(secret, body))
+
+def read_tracking_token(secret, token):
+    if not secret or token.count(".") != 1:
+        return None
+    body_part, sig_part = token.split(".")
+    try:
+        body = b64url_decode(body_part)
+        sig = b64url_decode(sig_part)
+    except Exception:
+        return None
+    if not hmac.compare_digest(sign_token(secret, body), sig):
+        return None
     try:
-        b64, hexs = compute_sigs(secret, payload_bytes)
-        if header_sig == b64 or header_sig == hexs:
-            return True
-        if header_sig and header_sig.startswith("sha256="):
-            if header_sig == "sha256=" + hexs:
-                return True
-        return False
+        fields = json.loads(body.decode("utf-8"))
     except Exception:
-        return False
+        return None
+    if not isinstance(fields, list) or len(fields) != len(TOKEN_FIELDS):
+        return None
+    return row_to_record(list(TOKEN_FIELDS) + ["Tracking Link"], fields + [make_tracking_link(token)])
+
+def new_tracking_id():
+    uid = str(uuid.uuid4())[:8]
+    if isinstance(storage, PartitionedSheetStorage):
+        # Month prefix: the lookup knows which worksheet to read. The month of the
+        # write, not of the order: late deliveries of old orders must not land in archived months
+        return partition_key(now_utc()) + "-" + uid
+    return uid
+
+def is_tracking_token(unique_id):
+    # Legacy IDs are uuid4()[:8] and never contain a dot
+    return "." in unique_id
+
+def find_tracking(unique_id):
+    if is_tracking_token(unique_id):
+        record = read_tracking_token(TRACKING_TOKEN_SECRET, unique_id)
+        if record is not None:
+            return record
+        # Secret unset or rotated: the row is still stored under the token
+    return storage.find(unique_id)
 
 # ---------- Realistic events templates (USA to Europe, 14-day total) ----------
 EVENTS_TEMPLATE_EN = [
@@ -164,29 +370,168 @@ EVENTS_TEMPLATE_NL = [
     {"title": "Bezorgpoging - neem contact op voor herplanning", "day": 19, "loc": "Bestemmingsland", "hour": 12, "minute": 40},
 ]
 
-# Funzione per scegliere il template in base al paese
-def get_events_template(country_code):
-    country = (country_code or "").upper()
-    if country == "IT":
-        return EVENTS_TEMPLATE_IT
-    elif country in ["DE", "AT", "CH"]:
-        return EVENTS_TEMPLATE_DE
-    elif country in ["SE", "NO", "DK"]:
-        return EVENTS_TEMPLATE_SE
-    elif country in ["NL", "BE"]:
-        return EVENTS_TEMPLATE_NL
+EVENTS_TEMPLATES = {
+    "EN": EVENTS_TEMPLATE_EN,
+    "IT": EVENTS_TEMPLATE_IT,
+    "DE": EVENTS_TEMPLATE_DE,
+    "SE": EVENTS_TEMPLATE_SE,
+    "NL": EVENTS_TEMPLATE_NL,
+}
+
+# Paese -> lingua del template (default EN)
+COUNTRY_LOCALES = {
+    "IT": "IT",
+    "DE": "DE", "AT": "DE", "CH": "DE",
+    "SE": "SE", "NO": "SE", "DK": "SE",
+    "NL": "NL", "BE": "NL",
+}
+
+# ---------- Timeline engine ----------
+# Final customs event: its location is replaced by "<postcode> <country>"
+FINAL_EVENT_DAY = 16
+
+def compile_events_template(template):
+    # (title, day, loc, hour, minute, is_final) tuples, built once at startup
+    return tuple((ev["title"], ev["day"], ev["loc"], ev.get("hour", 12), ev.get("minute", 0), ev["day"] == FINAL_EVENT_DAY)
+                 for ev in template)
+
+COMPILED_EVENTS = {locale: compile_events_template(t) for locale, t in EVENTS_TEMPLATES.items()}
+
+# Sceglie il template in base al paese
+def get_compiled_events(country_code):
+    return COMPILED_EVENTS[COUNTRY_LOCALES.get((country_code or "").upper(), "EN")]
+
+def timeline_clock(found, now=None):
+    """Return (created_dt, shipment_start, days_passed, next_change) for a record.
+
+    next_change is when days_passed next increments, i.e. when the rendered
+    timeline stops being valid.
+    """
+    created_at_raw = found.get("Created At") or found.get("created_at") or found.get("Data Ordine") or ""
+    created_dt = parse_datetime_iso(created_at_raw) or now_utc()
+    # Shipment starts 2 days after order creation
+    shipment_start = created_dt + timedelta(days=2)
+    elapsed = ((now or now_utc()) - shipment_start).days
+    days_passed = max(elapsed, 0)
+    return created_dt, shipment_start, days_passed, shipment_start + timedelta(days=days_passed + 1)
+
+def build_timeline(found, now=None, clock=None, with_events=True):
+    order_id = found.get("Order ID") or found.get("order_id") or found.get("Numero Ordine") or found.get("order") or found.get("Order") or ""
+    service = found.get("Service") or found.get("service") or "International Air Express"
+    country = found.get("Country") or found.get("country") or ""
+    city = found.get("City") or found.get("city") or ""
+    postcode = found.get("Postcode") or found.get("postcode") or ""
+    customer = found.get("Customer") or found.get("customer") or found.get("Cliente") or ""
+    status = found.get("Status") or found.get("status") or ""
+    total = found.get("Total") or found.get("total") or ""
+
+    created_dt, shipment_start, days_passed, _ = clock or timeline_clock(found, now)
+
+    is_delivered = days_passed >= 16
+    status_text = "DELIVERED" if is_delivered else ("IN TRANSIT" if days_passed >= 3 else "PREPARING SHIPMENT")
+
+    est_start = (shipment_start + timedelta(days=14)).date().isoformat()
+    est_end = est_start
+
+    final_loc = "{} {}".format(postcode, country).strip()
+    base_ordinal = shipment_start.toordinal()
+    sec, usec, tz = shipment_start.second, shipment_start.microsecond, shipment_start.tzinfo
+    events = []
+    for title, day, loc, hour, minute, is_final in get_compiled_events(country) if with_events else ():
+        d = date.fromordinal(base_ordinal + day)
+        ev_datetime = datetime(d.year, d.month, d.day, hour, minute, sec, usec, tz)
+        events.append({
+            "title": title,
+            "day_offset": day,
+            "date_iso": ev_datetime.isoformat(),
+            "date_readable": "{:02d}/{:02d}/{:04d}".format(d.day, d.month, d.year),
+            "location": final_loc if is_final else loc,
+            "occurred": days_passed >= day
+        })
+
+    payload = {
+        "order_id": order_id,
+        "customer": customer,
+        "service": service,
+        "country": country,
+        "city": city,
+        "postcode": postcode,
+        "status": status,
+        "total": total,
+        "created_at": created_dt.isoformat(),
+        "days_passed": days_passed,
+        "status_text": status_text,
+        "estimated_start": est_start,
+        "estimated_end": est_end,
+        "events": events
+    }
+    if not with_events:
+        del payload["events"]
+    return payload
+
+# ---------- Timeline response cache ----------
+TIMELINE_CACHE_SIZE = int(os.environ.get("TIMELINE_CACHE_SIZE", "4096"))
+# Bodies smaller than this are sent uncompressed
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "512"))
+
+timeline_cache = LRUCache(TIMELINE_CACHE_SIZE)
+
+def render_timeline(unique_id, found, kind="json"):
+    """Return the cache entry for a record's rendered timeline.
+
+    kind is "json" (API) or "html" (tracking page). The payload only changes
+    when days_passed ticks over, which happens at shipment_start + N days
+    rather than at UTC midnight, so entries are keyed by (ID, days_passed).
+    The record itself is kept alongside to catch rows edited in place.
+    """
+    now = now_utc()
+    clock = timeline_clock(found, now)
+    days_passed = clock[2]
+    key = (unique_id, days_passed, kind)
+    fingerprint = tuple(found.items())
+    hit = timeline_cache.get(key)
+    if hit is not None and hit["fingerprint"] == fingerprint:
+        return hit
+    timeline = build_timeline(found, now, clock)
+    if kind == "html":
+        body = render_template("track.html", uid=unique_id, timeline=timeline).encode("utf-8")
     else:
-        return EVENTS_TEMPLATE_EN
-
-# ---------- Utility: safe extract for nested keys ----------
-def safe_get(d, *keys, default=""):
-    cur = d or {}
-    for k in keys:
-        if isinstance(cur, dict):
-            cur = cur.get(k, {})
-        else:
-            return default
-    return cur if cur not in (None, {}) else default
+        body = app.json.response(timeline).get_data()
+    # Compressed variants are filled in lazily by cached_response()
+    entry = {"fingerprint": fingerprint, "etag": hashlib.sha1(body).hexdigest()[:20], "identity": body}
+    timeline_cache.put(key, entry)
+    return entry
+
+def pick_encoding(body):
+    if len(body) < COMPRESS_MIN_BYTES:
+        return "identity"
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return "identity"
+
+def cached_response(entry, mimetype):
+    encoding = pick_encoding(entry["identity"])
+    body = entry.get(encoding)
+    if body is None:
+        body = entry[encoding] = brotli.compress(entry["identity"]) if encoding == "br" \
+            else gzip.compress(entry["identity"], compresslevel=6)
+    resp = app.response_class(body, mimetype=mimetype)
+    if encoding != "identity":
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    # One strong ETag per representation
+    resp.set_etag(entry["etag"] if encoding == "identity" else "{}-{}".format(entry["etag"], encoding))
+    # Personal data and a status that can change at any time: only the browser keeps
+    # a copy, and revalidates it every time (a cheap 304 while the ETag matches)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+def timeline_response(unique_id, found):
+    return cached_response(render_timeline(unique_id, found), app.json.mimetype)
 
 # ---------- Root / health ----------
 @app.route("/", methods=["GET"])
@@ -194,23 +539,34 @@ def home():
     return jsonify({
         "status": "ok",
         "service": "tracking-backend",
-        "endpoints": ["/webhook (POST)", "/webhook-inspect (POST)", "/api/track/<id> (GET)", "/track/<id> (GET)"]
+        "endpoints": ["/webhook (POST)", "/webhook-inspect (POST)", "/api/track/<id> (GET)", "/api/track/batch (POST)", "/api/export (GET)", "/track/<id> (GET)", "/ready (GET)", "/metrics (GET)"]
     }), 200
 
+# ---------- Readiness (liveness stays on /) ----------
+@app.route("/ready", methods=["GET"])
+def ready():
+    is_ready = storage.is_ready() or not SHEETS_WARMUP
+    lazy = sheet.sheet if sheet is not None and isinstance(sheet.sheet, LazySheet) else None
+    body = {
+        "ready": is_ready,
+        "backend": STORAGE_BACKEND,
+        "sheet_open": lazy.is_open if lazy is not None else None,
+        "sheet_open_ms": round(lazy.open_seconds * 1000, 1) if lazy is not None and lazy.open_seconds else None,
+        "sheets_circuit_open": sheet.is_open if sheet is not None else None,
+        "boot": boot_times,
+    }
+    return jsonify(body), 200 if is_ready else 503
+
 # ---------- Inspect endpoint (temporary debug) ----------
 @app.route("/webhook-inspect", methods=["POST"])
 def webhook_inspect():
     payload_bytes = request.get_data()
     content_type = request.headers.get("Content-Type", "")
-    headers = dict(request.headers)
-    try:
-        preview = payload_bytes[:4000].decode("utf-8", errors="replace")
-    except Exception:
-        preview = str(payload_bytes[:4000])
-    print("INSPECT: content-type:", content_type)
-    print("INSPECT: headers:", json.dumps(headers))
-    print("INSPECT: payload_length:", len(payload_bytes))
-    print("INSPECT: payload_preview:", preview)
+    # Explicit debug endpoint: always captured when INFO is on, still capped at LOG_PAYLOAD_MAX_BYTES
+    if log.isEnabledFor(logging.INFO):
+        log.info("webhook inspect", extra=kv(content_type=content_type, headers=dict(request.headers),
+                                             payload_length=len(payload_bytes),
+                                             payload_preview=payload_preview(payload_bytes, sample_rate=1)))
     return jsonify({"status": "inspected", "content_type": content_type, "length": len(payload_bytes)}), 200
 
 # ---------- Webhook endpoint (production) ----------
@@ -219,119 +575,118 @@ def webhook():
     payload_bytes = request.get_data()
     content_type = request.headers.get("Content-Type", "")
 
-    if content_type and "application/x-www-form-urlencoded" in content_type:
-        form = request.form.to_dict()
-        if form and ("webhook_id" in form or "webhook" in form):
-            print("PING received (form):", form)
-            return jsonify({"status": "ping acknowledged"}), 200
+    # Body format is decided once; each format is decoded at most once
+    body_format = detect_format(content_type, payload_bytes)
+    form = parse_form(payload_bytes) if body_format == FORMAT_FORM else None
+    if is_ping(form):
+        if log.isEnabledFor(logging.INFO):
+            log.info("webhook ping", extra=kv(form=form))
+        return jsonify({"status": "ping acknowledged"}), 200
 
-    if DEBUG_SIG:
+    if DEBUG_SIG and log.isEnabledFor(logging.INFO):
         try:
             b64, hexs = compute_sigs(WC_SECRET, payload_bytes) if WC_SECRET else ("", "")
         except Exception as e:
             b64, hexs = ("ERR", "ERR")
-        print("DEBUG: content-type:", content_type)
-        print("DEBUG: payload_length:", len(payload_bytes))
-        print("DEBUG: computed_b64:", repr(b64))
-        print("DEBUG: computed_hex:", repr(hexs))
-        print("DEBUG: header_sig:", repr(request.headers.get("X-WC-Webhook-Signature", "")))
-        print("DEBUG: WC_SECRET present?:", bool(WC_SECRET))
+        log.info("webhook signature debug", extra=kv(
+            content_type=content_type, payload_length=len(payload_bytes), computed_b64=b64, computed_hex=hexs,
+            header_sig=request.headers.get("X-WC-Webhook-Signature", ""), secret_present=bool(WC_SECRET)))
 
     header_sig = request.headers.get("X-WC-Webhook-Signature", "")
     if WC_SECRET:
         if not header_sig:
-            print("WARN: signature header missing")
+            log.warning("webhook signature header missing")
+            metrics.inc("webhook_signature_failures_total", reason="missing")
             return jsonify({"error": "Missing signature header"}), 401
         if not verify_sig(WC_SECRET, payload_bytes, header_sig):
-            print("WARN: signature mismatch")
+            log.warning("webhook signature mismatch")
+            metrics.inc("webhook_signature_failures_total", reason="mismatch")
             return jsonify({"error": "Invalid webhook signature"}), 401
 
-    data = None
-    if request.is_json:
-        try:
-            data = request.get_json()
-        except Exception:
-            data = None
-
-    if data is None:
-        try:
-            form = request.form.to_dict()
-        except Exception:
-            form = {}
-        if form:
-            if len(form) == 1:
-                v = next(iter(form.values()))
-                try:
-                    data = json.loads(v)
-                except Exception:
-                    data = form
-            else:
-                data = form
+    # Sampled payload previews are INFO: not even drawn when that level is off
+    preview = payload_preview(payload_bytes) if log.isEnabledFor(logging.INFO) else None
+    if preview is not None:
+        log.info("webhook payload sample", extra=kv(content_type=content_type, payload_length=len(payload_bytes),
+                                                    payload_preview=preview))
 
-    if data is None:
-        try:
-            data = json.loads(payload_bytes.decode("utf-8"))
-        except Exception:
-            data = None
+    data = None
+    if body_format == FORMAT_JSON:
+        data = decode_json(payload_bytes)
+    elif body_format == FORMAT_FORM:
+        data = form_to_data(form)
+    elif body_format == FORMAT_MULTIPART:
+        data = form_to_data(request.form.to_dict())
 
     if data is None:
-        print("ERROR: Empty or unparseable payload; content-type:", content_type)
+        log.error("webhook payload empty or unparseable", extra=kv(
+            content_type=content_type, payload_length=len(payload_bytes), payload_preview=preview))
+        metrics.inc("webhook_parse_failures_total", reason="unparseable")
         return jsonify({"error": "Empty or unparseable payload", "hint": "Use /webhook-inspect to see raw body"}), 400
 
     if not isinstance(data, dict):
         if isinstance(data, list) and len(data) > 0 and isinstance(data[0], dict):
             data = data[0]
         else:
-            print("ERROR: Unexpected payload type:", type(data))
+            log.error("webhook payload has unexpected type", extra=kv(type=type(data).__name__))
+            metrics.inc("webhook_parse_failures_total", reason="unexpected_type")
             return jsonify({"error": "Unexpected payload type", "type": str(type(data))}), 400
 
-    status = (data.get("status") or "").lower()
-    if status not in ["processing", "completed", "paid"]:
-        print("IGNORED order status:", status, "order_id:", data.get("id"))
+    status = order_status(data)
+    if status not in ACCEPTED_STATUSES:
+        log.info("webhook order status ignored", extra=kv(status=status, order_id=data.get("id")))
+        metrics.inc("webhook_ignored_total", status=status or "none")
         return jsonify({"status": "ignored", "order_status": status}), 200
 
-    date_paid = data.get("date_paid")
-    date_completed = data.get("date_completed")
-    date_created = data.get("date_created") or data.get("created_at")
-    chosen_dt = None
-    for cand in (date_paid, date_completed, date_created):
-        if cand:
-            parsed = parse_datetime_iso(cand)
-            if parsed:
-                chosen_dt = parsed
-                break
-    if not chosen_dt:
-        chosen_dt = now_utc()
-    created_at_iso = chosen_dt.isoformat()
-
-    order_id = str(data.get("id") or data.get("number") or safe_get(data, "order_key") or "")
-    billing = data.get("billing") or {}
-    shipping = data.get("shipping") or {}
-    if not shipping or not any(shipping.values()):
-        shipping = billing or {}
-
-    customer_name = (billing.get("first_name", "") + " " + billing.get("last_name", "")).strip()
-    city = shipping.get("city", "") or shipping.get("town", "") or ""
-    postcode = shipping.get("postcode", "") or shipping.get("zip", "") or ""
-    country = shipping.get("country", "") or ""
-    total = data.get("total") or data.get("order_total") or ""
-
-    service = "International Air Express"
-    shipping_lines = data.get("shipping_lines") or data.get("shipping_lines", [])
-    if isinstance(shipping_lines, list) and len(shipping_lines) > 0:
-        first = shipping_lines[0]
-        if isinstance(first, dict):
-            service = first.get("method_title") or first.get("name") or service
+    row, _ = normalize_order(data, now_utc())
+    order_id, created_at_iso = row[0], row[2]
+    seen = None
+    if order_dedup is not None and order_id:
+        payload_hash = order_hash(row)
+        seen = order_dedup.get(order_id)
+        if seen is not None and seen[3] == payload_hash:
+            metrics.inc("webhook_duplicates_total")
+            return jsonify({"status": "success", "tracking_link": seen[1], "duplicate": True}), 200
+
+    if seen is None:
+        if TRACKING_TOKEN_SECRET:
+            unique_id = make_tracking_token(TRACKING_TOKEN_SECRET, row)
         else:
-            service = str(first)
+            unique_id = new_tracking_id()
+        tracking_link = make_tracking_link(unique_id)
+        row[1] = tracking_link
+        if order_dedup is not None and order_id:
+            seen = order_dedup.claim(order_id, unique_id, tracking_link, created_at_iso, payload_hash)
+            if seen is not None and seen[3] == payload_hash:
+                metrics.inc("webhook_duplicates_total")
+                return jsonify({"status": "success", "tracking_link": seen[1], "duplicate": True}), 200
 
-    unique_id = str(uuid.uuid4())[:8]
-    tracking_link = make_tracking_link(unique_id)
+    if seen is not None:
+        # Status transition of a known order: rewrite its row, keep link and start date
+        unique_id, tracking_link, row[2] = seen[0], seen[1], seen[2]
+        row[1] = tracking_link
+        try:
+            storage.update(unique_id, row)
+        except SheetsUnavailable as e:
+            return sheets_unavailable(e)
+        except PartitionArchived:
+            # The month was moved out of the spreadsheet: retrying cannot help, acknowledge it
+            log.warning("row update skipped, month archived", extra=kv(order_id=order_id, tracking_id=unique_id))
+            metrics.inc("webhook_archived_total")
+            return jsonify({"status": "archived", "tracking_link": tracking_link}), 200
+        except Exception as e:
+            log.error("row update failed", extra=kv(order_id=order_id, error=repr(e)))
+            return jsonify({"error": "Errore salvataggio su Google Sheet", "detail": str(e)}), 500
+        order_dedup.set_hash(order_id, payload_hash)
+        return jsonify({"status": "success", "tracking_link": tracking_link}), 200
 
     try:
-        sheet.append_row([order_id, tracking_link, created_at_iso, service, country, city, postcode, customer_name, status, total])
+        storage.append(unique_id, row)
     except Exception as e:
-        print("ERR append_row:", repr(e))
+        log.error("row append failed", extra=kv(order_id=order_id, error=repr(e)))
+        if order_dedup is not None and order_id:
+            order_dedup.forget(order_id)
+        if isinstance(e, SheetsUnavailable):
+            return sheets_unavailable(e)
         return jsonify({"error": "Errore salvataggio su Google Sheet", "detail": str(e)}), 500
 
     return jsonify({"status": "success", "tracking_link": tracking_link}), 200
@@ -340,90 +695,273 @@ def webhook():
 @app.route("/api/track/<unique_id>", methods=["GET"])
 def api_track(unique_id):
     try:
-        records = sheet.get_all_records()
+        found = find_tracking(unique_id)
+    except SheetsUnavailable:
+        raise
     except Exception as e:
         return jsonify({"error": "Errore lettura Sheet", "detail": str(e)}), 500
 
-    found = None
-    for r in records:
-        for v in r.values():
-            if isinstance(v, str) and unique_id in v:
-                found = r
-                break
-        if found:
-            break
-
     if not found:
         return jsonify({"error": "Tracking ID non trovato"}), 404
 
-    order_id = found.get("Order ID") or found.get("order_id") or found.get("Numero Ordine") or found.get("order") or found.get("Order") or ""
-    created_at_raw = found.get("Created At") or found.get("created_at") or found.get("Data Ordine") or ""
-    service = found.get("Service") or found.get("service") or "International Air Express"
-    country = found.get("Country") or found.get("country") or ""
-    city = found.get("City") or found.get("city") or ""
-    postcode = found.get("Postcode") or found.get("postcode") or ""
-    customer = found.get("Customer") or found.get("customer") or found.get("Cliente") or ""
-    status = found.get("Status") or found.get("status") or ""
-    total = found.get("Total") or found.get("total") or ""
+    return timeline_response(unique_id, found)
 
-    created_dt = parse_datetime_iso(created_at_raw) or now_utc()
+# ---------- API: many timelines at once (support dashboard, "my orders") ----------
+TRACK_BATCH_MAX_IDS = int(os.environ.get("TRACK_BATCH_MAX_IDS", "100"))
 
-    # Shipment starts 2 days after order creation
-    shipment_start = created_dt + timedelta(days=2)
-    days_passed = (now_utc() - shipment_start).days
-    if days_passed < 0:
-        days_passed = 0
+@app.route("/api/track/batch", methods=["POST"])
+def api_track_batch():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "Expected a JSON object with an \"ids\" list"}), 400
+    ids = body.get("ids")
+    fields = body.get("fields")
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, str) and i for i in ids):
+        return jsonify({"error": "\"ids\" must be a non-empty list of tracking IDs"}), 400
+    if len(ids) > TRACK_BATCH_MAX_IDS:
+        return jsonify({"error": "Too many ids", "max": TRACK_BATCH_MAX_IDS}), 400
+    if fields is not None and (not isinstance(fields, list) or not all(isinstance(f, str) for f in fields)):
+        return jsonify({"error": "\"fields\" must be a list of field names"}), 400
 
-    is_delivered = days_passed >= 16
-    status_text = "DELIVERED" if is_delivered else ("IN TRANSIT" if days_passed >= 3 else "PREPARING SHIPMENT")
+    ids = list(dict.fromkeys(ids))
+    found = {uid: read_tracking_token(TRACKING_TOKEN_SECRET, uid) for uid in ids if is_tracking_token(uid)}
+    # Legacy IDs, and tokens that no longer verify (secret unset or rotated), go to storage
+    legacy_ids = [uid for uid in ids if found.get(uid) is None]
+    if legacy_ids:
+        try:
+            found.update(storage.find_many(legacy_ids))
+        except SheetsUnavailable:
+            raise
+        except Exception as e:
+            return jsonify({"error": "Errore lettura Sheet", "detail": str(e)}), 500
 
-    est_start = (shipment_start + timedelta(days=14)).date().isoformat()
-    est_end = est_start
+    with_events = fields is None or "events" in fields
+    now = now_utc()
+    results = {}
+    for uid in ids:
+        record = found.get(uid)
+        if not record:
+            results[uid] = {"error": "Tracking ID non trovato"}
+            continue
+        payload = build_timeline(record, now, with_events=with_events)
+        if fields is not None:
+            payload = {k: payload[k] for k in fields if k in payload}
+        results[uid] = payload
+    return jsonify({"results": results}), 200
 
-    # Seleziona il template degli eventi in base al paese
-    events_template = get_events_template(country)
-    
-    events = []
-    for ev in events_template:
-        # Crea la data con orario specifico
-        ev_date = shipment_start + timedelta(days=ev["day"])
-        ev_datetime = ev_date.replace(hour=ev.get("hour", 12), minute=ev.get("minute", 0))
-        
-        loc = ev["loc"]
-        # Controlla se è l'evento finale di sdoganamento (giorno 16 in tutti i template)
-        if ev["day"] == 16:
-            loc = "{} {}".format(postcode, country).strip()
-        events.append({
-            "title": ev["title"],
-            "day_offset": ev["day"],
-            "date_iso": ev_datetime.isoformat(),
-            "date_readable": ev_datetime.strftime("%d/%m/%Y"),
-            "location": loc,
-            "occurred": days_passed >= ev["day"]
-        })
+# ---------- Export: every order with its computed status (reconciliation) ----------
+# Bearer token for /api/export; the endpoint is off when unset
+EXPORT_TOKEN = os.environ.get("EXPORT_TOKEN", "")
+EXPORT_FIELDS = ["order_id", "tracking_id", "created_at", "service", "country", "city", "postcode", "customer",
+                 "status", "total", "days_passed", "status_text", "estimated_end"]
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# Output is flushed to the client in chunks of about this many characters
+EXPORT_CHUNK_CHARS = 64 * 1024
 
-    payload = {
-        "order_id": order_id,
-        "customer": customer,
-        "service": service,
-        "country": country,
-        "city": city,
-        "postcode": postcode,
-        "status": status,
-        "total": total,
-        "created_at": created_dt.isoformat(),
-        "days_passed": days_passed,
-        "status_text": status_text,
-        "estimated_start": est_start,
-        "estimated_end": est_end,
-        "events": events
+def export_filters(since=None, until=None, country=None, status=None, status_text=None):
+    """Normalize export filters; since/until are YYYY-MM-DD strings, the others comma-separated lists.
+
+    Raises ValueError for malformed dates.
+    """
+    def values(raw, upper=False):
+        items = [v.strip() for v in (raw or "").split(",") if v.strip()]
+        return {v.upper() if upper else v.lower() for v in items} or None
+    return {
+        "since": date.fromisoformat(since) if since else None,
+        "until": date.fromisoformat(until) if until else None,
+        "countries": values(country, upper=True),
+        "statuses": values(status),
+        "status_texts": values(status_text, upper=True),
     }
 
-    return jsonify(payload), 200
+def export_records(filters):
+    """Yield export rows (EXPORT_FIELDS) for the orders matching filters, reading storage page by page."""
+    since, until = filters["since"], filters["until"]
+    since_iso = since.isoformat() if since else None
+    # Inclusive end date: compare against the start of the next day
+    until_iso = (until + timedelta(days=1)).isoformat() if until else None
+    countries, statuses, status_texts = filters["countries"], filters["statuses"], filters["status_texts"]
+    now = now_utc()
+    for record in storage.iter_records(since=since, until=until):
+        # Filter on the timeline payload: it accepts the alternative header names
+        payload = build_timeline(record, now, with_events=False)
+        if countries and str(payload["country"] or "").upper() not in countries:
+            continue
+        if statuses and str(payload["status"] or "").lower() not in statuses:
+            continue
+        created = payload["created_at"]
+        if (since_iso and created < since_iso) or (until_iso and created >= until_iso):
+            continue
+        if status_texts and payload["status_text"] not in status_texts:
+            continue
+        header = list(record)
+        payload["tracking_id"] = tracking_id_from_link(record[header[link_column(header)]]) if header else ""
+        yield {k: payload.get(k, "") for k in EXPORT_FIELDS}
+
+def export_chunks(fmt, filters):
+    """Serialize export_records() as NDJSON or CSV, in chunks of about EXPORT_CHUNK_CHARS."""
+    buf = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(buf, fieldnames=EXPORT_FIELDS, lineterminator="\n")
+        writer.writeheader()
+    rows = 0
+    try:
+        for row in export_records(filters):
+            if writer is not None:
+                writer.writerow(row)
+            else:
+                buf.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")))
+                buf.write("\n")
+            rows += 1
+            if buf.tell() >= EXPORT_CHUNK_CHARS:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+    except Exception as e:
+        # Headers are already out: the client sees a truncated body
+        log.error("export aborted", extra=kv(rows=rows, error=repr(e)))
+        raise
+    yield buf.getvalue()
+    log.info("export done", extra=kv(format=fmt, rows=rows))
+
+@app.route("/api/export", methods=["GET"])
+def api_export():
+    if not EXPORT_TOKEN:
+        return jsonify({"error": "Export non abilitato"}), 404
+    # Bytes: compare_digest() raises TypeError on str with non-ASCII characters
+    if not hmac.compare_digest(request.headers.get("Authorization", "").encode("utf-8"),
+                               ("Bearer " + EXPORT_TOKEN).encode("utf-8")):
+        return jsonify({"error": "Unauthorized"}), 401
+    fmt = request.args.get("format", "ndjson").lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "\"format\" must be one of: " + ", ".join(EXPORT_FORMATS)}), 400
+    try:
+        filters = export_filters(request.args.get("from"), request.args.get("to"), request.args.get("country"),
+                                 request.args.get("status"), request.args.get("status_text"))
+    except ValueError:
+        return jsonify({"error": "\"from\" and \"to\" must be dates (YYYY-MM-DD)"}), 400
+    resp = app.response_class(export_chunks(fmt, filters), mimetype=EXPORT_FORMATS[fmt])
+    resp.headers["Content-Disposition"] = "attachment; filename=orders-{}.{}".format(now_utc().strftime("%Y%m%d"), fmt)
+    resp.cache_control.no_store = True
+    return resp
+
+@app.cli.command("export-orders")
+@click.option("--format", "fmt", type=click.Choice(sorted(EXPORT_FORMATS)), default="ndjson", show_default=True)
+@click.option("--from", "since", help="First order date (YYYY-MM-DD), inclusive.")
+@click.option("--to", "until", help="Last order date (YYYY-MM-DD), inclusive.")
+@click.option("--country", help="Comma-separated country codes.")
+@click.option("--status", help="Comma-separated order statuses (processing, completed, ...).")
+@click.option("--status-text", help="Comma-separated computed statuses (IN TRANSIT, DELIVERED, ...).")
+@click.option("--output", "-o", default="-", help="Output file, - for stdout.")
+def export_orders(fmt, since, until, country, status, status_text, output):
+    """Stream every tracked order with its computed status as NDJSON or CSV."""
+    try:
+        filters = export_filters(since, until, country, status, status_text)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    with click.open_file(output, "w", encoding="utf-8") as out:
+        for chunk in export_chunks(fmt, filters):
+            out.write(chunk)
+
+# ---------- CLI: backfill / replay of an order export ----------
+def backfill_chunk(rows, dry_run=False):
+    """Dedup one chunk of normalized rows, give new orders a tracking ID and write them with append_many()."""
+    counts = Counter()
+    appends = []
+    position = {}
+    claimed = []
+    merged = set()
+    for row in rows:
+        order_id = row[0]
+        payload_hash = order_hash(row)
+        if order_id in position:
+            # Same order again further down the export: keep its ID, last version wins
+            unique_id, first = appends[position[order_id]]
+            row[1], row[2] = first[1], first[2]
+            appends[position[order_id]] = (unique_id, row)
+            merged.add(order_id)
+            counts["merged"] += 1
+            continue
+        seen = order_dedup.get(order_id) if order_dedup is not None and order_id else None
+        if seen is not None and seen[3] == payload_hash:
+            counts["duplicate"] += 1
+            continue
+        if seen is not None:
+            if not dry_run:
+                row[1], row[2] = seen[1], seen[2]
+                try:
+                    storage.update(seen[0], row)
+                except PartitionArchived:
+                    counts["archived"] += 1
+                    continue
+                order_dedup.set_hash(order_id, payload_hash)
+            counts["update"] += 1
+            continue
+        if TRACKING_TOKEN_SECRET:
+            unique_id = make_tracking_token(TRACKING_TOKEN_SECRET, row)
+        else:
+            unique_id = new_tracking_id()
+        row[1] = make_tracking_link(unique_id)
+        if not dry_run and order_dedup is not None and order_id:
+            if order_dedup.claim(order_id, unique_id, row[1], row[2], payload_hash) is not None:
+                # A webhook delivery for this order got there first
+                counts["duplicate"] += 1
+                continue
+            claimed.append(order_id)
+        if order_id:
+            position[order_id] = len(appends)
+        appends.append((unique_id, row))
+    if appends and not dry_run:
+        try:
+            storage.append_many(appends)
+        except Exception:
+            for order_id in claimed:
+                order_dedup.forget(order_id)
+            raise
+        if order_dedup is not None:
+            # The claim stored the first version's hash; the last one was written
+            for unique_id, row in appends:
+                if row[0] in merged:
+                    order_dedup.set_hash(row[0], order_hash(row))
+    counts["append"] += len(appends)
+    return counts
+
+@app.cli.command("backfill")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(backfill.FORMATS), help="Default: from the file extension.")
+@click.option("--chunk-size", default=500, show_default=True, help="Orders per chunk (one append_rows call).")
+@click.option("--workers", type=int, help="Parsing processes [default: CPU count].")
+@click.option("--checkpoint", help="Progress file [default: PATH.checkpoint.json].")
+@click.option("--restart", is_flag=True, help="Ignore an existing checkpoint and start from the top.")
+@click.option("--dry-run", is_flag=True, help="Parse, normalize and dedup only; report throughput, write nothing.")
+def backfill_orders(path, fmt, chunk_size, workers, checkpoint, restart, dry_run):
+    """Replay a WooCommerce order export (JSON lines or CSV) into storage, like /webhook would."""
+    checkpoint = checkpoint or path + ".checkpoint.json"
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    counts, seconds = backfill.run(path, backfill_chunk, fmt=fmt, chunk_size=chunk_size, workers=workers,
+                                   checkpoint=checkpoint, dry_run=dry_run, echo=click.echo)
+    if not dry_run:
+        # Rows journaled in the spool go out before the command returns
+        storage.close()
+    records = counts.pop("records", 0)
+    click.echo("{} {} records in {:.1f}s ({:.0f} records/s)".format(
+        "dry run:" if dry_run else "done:", records, seconds, records / seconds if seconds else 0))
+    for outcome in ("append", "update", "duplicate", "merged", "archived", "ignored", "invalid"):
+        click.echo("  {:<10} {}".format(outcome, counts.get(outcome, 0)))
+    if dry_run:
+        click.echo("  ~{} append_rows calls at --chunk-size {}".format(-(-counts.get("append", 0) // chunk_size), chunk_size))
+
+# ---------- Customer tracking page ----------
+# Render the timeline server-side (templates/track.html); "0" serves the old
+# shell page that fetches /api/track from the browser
+TRACK_PAGE_SSR = os.environ.get("TRACK_PAGE_SSR", "1").lower() in ("1", "true", "yes")
 
-# ---------- Debug HTML route (renders JSON) ----------
 @app.route("/track/<unique_id>")
 def track_html(unique_id):
+    if TRACK_PAGE_SSR:
+        return track_page(unique_id)
     api_url = "/api/track/{}".format(unique_id)
     html = """
     <!doctype html>
@@ -449,7 +987,45 @@ def track_html(unique_id):
     </html>
     """.replace("{uid}", unique_id).replace("{api}", api_url)
     return html
+
+def track_page(unique_id):
+    try:
+        found = find_tracking(unique_id)
+    except Exception as e:
+        log.error("tracking page lookup failed", extra=kv(tracking_id=unique_id, error=repr(e)))
+        resp = app.make_response((render_template("track.html", uid=unique_id, timeline=None,
+                                                  error="Tracking temporaneamente non disponibile, riprova tra poco."), 500))
+        if isinstance(e, SheetsUnavailable):
+            resp.status_code = 503
+            resp.headers["Retry-After"] = str(e.retry_after)
+        return resp
+    if not found:
+        return render_template("track.html", uid=unique_id, timeline=None, error="Tracking ID non trovato"), 404
+    return cached_response(render_timeline(unique_id, found, kind="html"), "text/html")
  
+# ---------- CLI: archive old months (SHEET_PARTITIONS=month) ----------
+@app.cli.command("archive-partitions")
+@click.option("--keep-months", default=6, show_default=True, help="Months left in the Sheet, current one included.")
+@click.option("--dry-run", is_flag=True, help="Only list the months that would be archived.")
+def archive_partitions(keep_months, dry_run):
+    """Move old monthly worksheets to gzip files in SHEET_ARCHIVE_DIR."""
+    if not isinstance(storage, PartitionedSheetStorage):
+        raise click.ClickException("archive-partitions needs SHEET_PARTITIONS=month")
+    today = now_utc().date()
+    oldest_kept = today.year * 12 + today.month - keep_months
+    cutoff = "{:02d}{:02d}".format(oldest_kept // 12 % 100, oldest_kept % 12 + 1)
+    if storage.flusher is not None:
+        storage.flusher.drain()
+    for key in storage.partitions():
+        if key >= cutoff:
+            continue
+        if dry_run:
+            click.echo("{}: would be archived".format(partition_title(key)))
+        else:
+            click.echo("{}: {} rows archived".format(partition_title(key), storage.archive(key)))
+
+boot_times["import_ms"] = round((time.monotonic() - BOOT_STARTED) * 1000, 1)
+
 # ---------- Run ----------
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
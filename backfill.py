@@ -0,0 +1,161 @@
+"""Replay a WooCommerce order export (JSON lines or CSV) into storage.
+
+Orders go through the same normalization as /webhook. Parsing runs on a
+process pool; the caller writes each chunk (append_many) and the position
+is checkpointed after every chunk, so an interrupted run resumes where it
+stopped. Kept free of app imports so pool workers start cheaply.
+"""
+import os
+import csv
+import json
+import time
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from wc_payload import json_loads, normalize_order, order_status, ACCEPTED_STATUSES
+
+FORMATS = ("jsonl", "csv")
+
+# ---------- Reading ----------
+def unflatten(flat):
+    """CSV columns with dotted names to nested data.
+
+    {"billing.first_name": "A", "shipping_lines.0.method_title": "X"}
+    -> {"billing": {"first_name": "A"}, "shipping_lines": [{"method_title": "X"}]}
+    """
+    data = {}
+    for key, value in flat.items():
+        if key is None or value in (None, ""):
+            continue
+        parts = key.split(".")
+        cur = data
+        for part, nxt in zip(parts, parts[1:]):
+            if not isinstance(cur, (dict, list)):
+                break
+            child = [] if nxt.isdigit() else {}
+            if isinstance(cur, list):
+                i = int(part)
+                while len(cur) <= i:
+                    cur.append(None)
+                if cur[i] is None:
+                    cur[i] = child
+                cur = cur[i]
+            else:
+                cur = cur.setdefault(part, child)
+        last = parts[-1]
+        if isinstance(cur, list):
+            i = int(last)
+            while len(cur) <= i:
+                cur.append(None)
+            cur[i] = value
+        elif isinstance(cur, dict):
+            cur[last] = value
+    return data
+
+def detect_source_format(path):
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+def read_orders(path, fmt, skip=0):
+    """Yield raw orders (a JSON line or a CSV row dict), skipping the first `skip` records."""
+    with open(path, encoding="utf-8", newline="") as f:
+        records = csv.DictReader(f) if fmt == "csv" else (line for line in f if line.strip())
+        for n, item in enumerate(records):
+            if n >= skip:
+                yield item
+
+# ---------- Preprocessing (runs in pool workers) ----------
+def prepare(item):
+    """("ok", row) | ("ignored", status) | ("invalid", reason) for one raw order."""
+    if isinstance(item, dict):
+        data = unflatten(item)
+    else:
+        try:
+            data = json_loads(item)
+        except Exception:
+            return "invalid", "json"
+    if not isinstance(data, dict):
+        return "invalid", "type"
+    status = order_status(data)
+    if status not in ACCEPTED_STATUSES:
+        return "ignored", status
+    row, _ = normalize_order(data)
+    return "ok", row
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# ---------- Checkpoints ----------
+def load_checkpoint(path, source):
+    """Records already written for this source file, 0 when starting over."""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return 0, Counter()
+    if state.get("source") != os.path.abspath(source) or state.get("size") != os.path.getsize(source):
+        # Different or modified export: the stored position means nothing
+        return 0, Counter()
+    return state.get("records", 0), Counter(state.get("counts", {}))
+
+def save_checkpoint(path, source, records, counts):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"source": os.path.abspath(source), "size": os.path.getsize(source), "records": records,
+                   "counts": dict(counts), "saved_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}, f)
+    os.replace(tmp, path)
+
+# ---------- Driver ----------
+def run(path, write_chunk, fmt=None, chunk_size=500, workers=None, checkpoint=None, dry_run=False, echo=print):
+    """Normalize the export chunk by chunk and hand the accepted rows to write_chunk(rows, dry_run).
+
+    write_chunk returns a Counter of outcomes (append, update, duplicate, ...).
+    Returns (counts, seconds).
+    """
+    fmt = fmt or detect_source_format(path)
+    workers = workers or os.cpu_count() or 1
+    done, counts = (0, Counter()) if dry_run or not checkpoint else load_checkpoint(checkpoint, path)
+    if done:
+        echo("resuming after {} records".format(done))
+    pool = None
+    if workers > 1:
+        # spawn: the parent may already run threads (flusher, log writer) that fork would copy mid-flight
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    started = time.perf_counter()
+    def submit(chunk):
+        if chunk is None:
+            return None
+        if pool is None:
+            return chunk, map(prepare, chunk)
+        return chunk, pool.map(prepare, chunk, chunksize=max(1, len(chunk) // (workers * 4)))
+
+    try:
+        source = chunks(read_orders(path, fmt, skip=done), chunk_size)
+        ahead = submit(next(source, None))
+        while ahead is not None:
+            chunk, results = ahead
+            # The pool parses the next chunk while this one is written
+            ahead = submit(next(source, None))
+            rows = []
+            for outcome, value in results:
+                if outcome == "ok":
+                    rows.append(value)
+                else:
+                    counts[outcome] += 1
+            if rows:
+                counts.update(write_chunk(rows, dry_run))
+            done += len(chunk)
+            counts["records"] = done
+            if checkpoint and not dry_run:
+                save_checkpoint(checkpoint, path, done, counts)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return counts, time.perf_counter() - started
@@ -0,0 +1,156 @@
+"""Microbenchmark: webhook body parsing + signature check, before vs after.
+
+Runs both paths inside a Flask request context with a WooCommerce-sized
+order payload and prints CPU microseconds per request.
+
+    python bench/bench_webhook_parse.py [iterations]
+"""
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import hmac
+from urllib.parse import urlencode
+
+from flask import Flask, request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import wc_payload  # noqa: E402
+
+SECRET = "wc-bench-secret"
+
+def woo_order(n_items=6):
+    # Shape and size of a real WooCommerce v3 "order.updated" delivery (~6 KB)
+    address = {"first_name": "Giulia", "last_name": "Bianchi", "company": "", "address_1": "Via Roma 12",
+               "address_2": "Scala B", "city": "Milano", "state": "MI", "postcode": "20121", "country": "IT",
+               "email": "giulia.bianchi@example.com", "phone": "+39 333 1234567"}
+    items = [{"id": 100 + i, "name": "Product {}".format(i), "product_id": 2000 + i, "variation_id": 0,
+              "quantity": 1 + i % 3, "tax_class": "", "subtotal": "19.90", "subtotal_tax": "4.38", "total": "19.90",
+              "total_tax": "4.38", "taxes": [{"id": 1, "total": "4.38", "subtotal": "4.38"}],
+              "meta_data": [{"id": 900 + i, "key": "pa_size", "value": "M", "display_key": "Size", "display_value": "M"}],
+              "sku": "SKU-{:04d}".format(i), "price": 19.9, "image": {"id": 3000 + i, "src": "https://shop.example.com/img/{}.jpg".format(i)},
+              "parent_name": None} for i in range(n_items)]
+    return {
+        "id": 48213, "parent_id": 0, "status": "processing", "currency": "EUR", "version": "9.3.3",
+        "prices_include_tax": True, "date_created": "2026-10-12T09:41:07", "date_modified": "2026-10-12T09:41:09",
+        "discount_total": "0.00", "discount_tax": "0.00", "shipping_total": "9.90", "shipping_tax": "0.00",
+        "cart_tax": "26.28", "total": "129.30", "total_tax": "26.28", "customer_id": 5521, "order_key": "wc_order_Xa81kq2LmP0vZ",
+        "billing": address, "shipping": dict(address, email=None, phone=""), "payment_method": "stripe",
+        "payment_method_title": "Credit card", "transaction_id": "pi_3Q8xYzA1b2C3d4E5", "customer_ip_address": "93.44.12.7",
+        "customer_user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 17_5 like Mac OS X) AppleWebKit/605.1.15",
+        "created_via": "checkout", "customer_note": "", "date_completed": None, "date_paid": "2026-10-12T09:41:09",
+        "cart_hash": "5c1ac8f0e0c5a1b3d9d7a0e2f4b6c8d0", "number": "48213",
+        "meta_data": [{"id": 77000 + i, "key": "_meta_{}".format(i), "value": "x" * 24} for i in range(12)],
+        "line_items": items, "tax_lines": [{"id": 1, "rate_code": "IT-IVA-1", "rate_id": 1, "label": "IVA", "compound": False,
+                                            "tax_total": "26.28", "shipping_tax_total": "0.00", "rate_percent": 22, "meta_data": []}],
+        "shipping_lines": [{"id": 55, "method_title": "International Air Express", "method_id": "flat_rate", "instance_id": "3",
+                            "total": "9.90", "total_tax": "0.00", "taxes": [], "meta_data": []}],
+        "fee_lines": [], "coupon_lines": [], "refunds": [], "payment_url": "https://shop.example.com/checkout/order-pay/48213/",
+        "is_editable": False, "needs_payment": False, "needs_processing": True,
+        "date_created_gmt": "2026-10-12T07:41:07", "date_modified_gmt": "2026-10-12T07:41:09",
+        "date_completed_gmt": None, "date_paid_gmt": "2026-10-12T07:41:09", "currency_symbol": "€",
+        "_links": {"self": [{"href": "https://shop.example.com/wp-json/wc/v3/orders/48213"}],
+                   "collection": [{"href": "https://shop.example.com/wp-json/wc/v3/orders"}]},
+    }
+
+# ---------- Before: parsing and verification as webhook() did it ----------
+def legacy_compute_sigs(secret, payload_bytes):
+    digest = hmac.new(secret.encode("utf-8"), payload_bytes, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode(), digest.hex()
+
+def legacy_verify_sig(secret, payload_bytes, header_sig):
+    b64, hexs = legacy_compute_sigs(secret, payload_bytes)
+    if header_sig == b64 or header_sig == hexs:
+        return True
+    return bool(header_sig) and header_sig.startswith("sha256=") and header_sig == "sha256=" + hexs
+
+def legacy_parse():
+    payload_bytes = request.get_data()
+    content_type = request.headers.get("Content-Type", "")
+    if content_type and "application/x-www-form-urlencoded" in content_type:
+        form = request.form.to_dict()
+        if form and ("webhook_id" in form or "webhook" in form):
+            return None
+    ok = legacy_verify_sig(SECRET, payload_bytes, request.headers.get("X-WC-Webhook-Signature", ""))
+    data = None
+    if request.is_json:
+        try:
+            data = request.get_json()
+        except Exception:
+            data = None
+    if data is None:
+        form = request.form.to_dict()
+        if form:
+            if len(form) == 1:
+                v = next(iter(form.values()))
+                try:
+                    data = json.loads(v)
+                except Exception:
+                    data = form
+            else:
+                data = form
+    if data is None:
+        try:
+            data = json.loads(payload_bytes.decode("utf-8"))
+        except Exception:
+            data = None
+    return ok, data
+
+# ---------- After: wc_payload fast path ----------
+def fast_parse():
+    payload_bytes = request.get_data()
+    content_type = request.headers.get("Content-Type", "")
+    body_format = wc_payload.detect_format(content_type, payload_bytes)
+    form = wc_payload.parse_form(payload_bytes) if body_format == wc_payload.FORMAT_FORM else None
+    if wc_payload.is_ping(form):
+        return None
+    ok = wc_payload.verify_sig(SECRET, payload_bytes, request.headers.get("X-WC-Webhook-Signature", ""))
+    if body_format == wc_payload.FORMAT_JSON:
+        data = wc_payload.decode_json(payload_bytes)
+    elif body_format == wc_payload.FORMAT_FORM:
+        data = wc_payload.form_to_data(form)
+    else:
+        data = wc_payload.form_to_data(request.form.to_dict())
+    return ok, data
+
+def cpu_us_per_call(app, fn, body, headers, iterations):
+    start = time.process_time()
+    for _ in range(iterations):
+        with app.test_request_context("/webhook", method="POST", data=body, headers=headers):
+            result = fn()
+    elapsed = time.process_time() - start
+    if fn is not context_only:
+        assert result[0] and result[1]["id"] == 48213
+    return elapsed / iterations * 1e6
+
+def context_only():
+    return None
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    app = Flask(__name__)
+    body = json.dumps(woo_order()).encode("utf-8")
+    form_body = urlencode({"payload": body.decode("utf-8")}).encode("utf-8")
+    sig = base64.b64encode(hmac.new(SECRET.encode(), body, hashlib.sha256).digest()).decode()
+    form_sig = base64.b64encode(hmac.new(SECRET.encode(), form_body, hashlib.sha256).digest()).decode()
+    cases = [
+        ("json, base64 sig", body, {"Content-Type": "application/json", "X-WC-Webhook-Signature": sig}),
+        ("json, no content-type", body, {"X-WC-Webhook-Signature": sig}),
+        ("form-wrapped json", form_body, {"Content-Type": "application/x-www-form-urlencoded",
+                                          "X-WC-Webhook-Signature": form_sig}),
+    ]
+    print("payload: {} bytes, json decoder: {}, {} iterations".format(
+        len(body), "orjson" if wc_payload.orjson else "stdlib json", iterations))
+    print("{:<24} {:>12} {:>12} {:>8}".format("case", "before us", "after us", "speedup"))
+    for name, payload, headers in cases:
+        before = cpu_us_per_call(app, legacy_parse, payload, headers, iterations)
+        after = cpu_us_per_call(app, fast_parse, payload, headers, iterations)
+        print("{:<24} {:>12.1f} {:>12.1f} {:>7.2f}x".format(name, before, after, before / after))
+    # Building the test request context is included in both columns above
+    overhead = cpu_us_per_call(app, context_only, body, cases[0][2], iterations)
+    print("{:<24} {:>12.1f}".format("request context only", overhead))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""In-memory stand-in for a gspread Worksheet, for offline benchmarks.
+
+Implements the subset of the Worksheet API the app uses, with a configurable
+simulated round-trip latency per call. Sheets can be saved to / loaded from a
+JSON-lines file so large fixtures are generated once.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+
+from gspread.cell import Cell
+from gspread.utils import a1_range_to_grid_range, numericise_all
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from storage import SHEET_COLUMNS  # noqa: E402
+
+TRACK_URL = "https://tracking-backend-tb40.onrender.com/track/{}"
+COUNTRIES = ["IT", "DE", "AT", "FR", "ES", "NL", "BE", "SE", "DK", "US"]
+
+class FakeWorksheet:
+    def __init__(self, rows=None, latency=0.0, jitter=0.0, title="Sheet1"):
+        self.title = title
+        self.rows = rows if rows is not None else [list(SHEET_COLUMNS)]
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+
+    # ---------- fixtures ----------
+    @classmethod
+    def generate(cls, n_rows, seed=42, **kwargs):
+        """Sheet with a header and n_rows orders spread over the last 60 days."""
+        rnd = random.Random(seed)
+        start = datetime(2026, 8, 1, 8, 0, 0)
+        rows = [list(SHEET_COLUMNS)]
+        for i in range(n_rows):
+            uid = uuid.UUID(int=rnd.getrandbits(128), version=4).hex[:8]
+            created = start + timedelta(seconds=rnd.randint(0, 60 * 86400))
+            country = COUNTRIES[i % len(COUNTRIES)]
+            rows.append([str(10000 + i), TRACK_URL.format(uid), created.isoformat(), "International Air Express",
+                         country, "City {}".format(i % 500), "{:05d}".format(rnd.randint(1000, 99999)),
+                         "Customer {}".format(i), "processing", "{:.2f}".format(rnd.uniform(10, 300))])
+        return cls(rows, **kwargs)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(path, encoding="utf-8") as f:
+            return cls([json.loads(line) for line in f], **kwargs)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for row in self.rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def tracking_ids(self):
+        return [row[1].rsplit("/", 1)[-1] for row in self.rows[1:]]
+
+    # ---------- Worksheet API ----------
+    def _call(self, op):
+        self.calls[op] += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def _rows_in(self, range_name):
+        grid = a1_range_to_grid_range(range_name)
+        r1 = grid.get("startRowIndex", 0)
+        r2 = grid.get("endRowIndex", len(self.rows))
+        c1 = grid.get("startColumnIndex", 0)
+        c2 = grid.get("endColumnIndex", len(SHEET_COLUMNS))
+        return r1, r2, c1, c2
+
+    def append_row(self, values, **kwargs):
+        self._call("append_row")
+        self.rows.append([str(v) for v in values])
+        return {"updates": {"updatedRows": 1}}
+
+    def append_rows(self, values, **kwargs):
+        self._call("append_rows")
+        self.rows.extend([str(v) for v in row] for row in values)
+        return {"updates": {"updatedRows": len(values)}}
+
+    def get_all_values(self, **kwargs):
+        self._call("get_all_values")
+        return list(self.rows)
+
+    def get_all_records(self, **kwargs):
+        self._call("get_all_records")
+        header = self.rows[0]
+        return [dict(zip(header, numericise_all(row))) for row in self.rows[1:]]
+
+    def get(self, range_name=None, **kwargs):
+        self._call("get")
+        r1, r2, c1, c2 = self._rows_in(range_name)
+        return [row[c1:c2] for row in self.rows[r1:r2]]
+
+    def row_values(self, row, **kwargs):
+        self._call("row_values")
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def find(self, query, in_row=None, in_column=None, **kwargs):
+        self._call("find")
+        for r, row in enumerate(self.rows, start=1):
+            if in_row is not None and r != in_row:
+                continue
+            for c, value in enumerate(row, start=1):
+                if value == query and (in_column is None or c == in_column):
+                    return Cell(r, c, value)
+        return None
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self._call("update")
+        r1, _, c1, _ = self._rows_in(range_name)
+        for offset, new in enumerate(values):
+            row = self.rows[r1 + offset]
+            row.extend([""] * (c1 + len(new) - len(row)))
+            row[c1:c1 + len(new)] = [str(v) for v in new]
+        return {}
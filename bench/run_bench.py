@@ -0,0 +1,186 @@
+"""Offline load benchmark for webhook and api_track against a fake Sheet.
+
+Drives the Flask app through its test client with FakeWorksheet standing in
+for Google Sheets, at several sheet sizes, and reports p50/p99 latency,
+throughput, Sheets calls and memory per endpoint.
+
+    python bench/run_bench.py                                  # print results
+    python bench/run_bench.py --save bench/baseline.json       # refresh the baseline
+    python bench/run_bench.py --compare bench/baseline.json    # flag regressions (exit 1)
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import sqlite3
+import tempfile
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+# Ratio over the baseline p50/p99 that counts as a regression
+REGRESSION_RATIO = 1.5
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+def measure(client, fake, requests):
+    """Run (method, url, json) requests; return latency/throughput/call stats."""
+    calls_before = sum(fake.calls.values())
+    latencies = []
+    started = time.perf_counter()
+    for method, url, body in requests:
+        t0 = time.perf_counter()
+        resp = client.open(url, method=method, json=body)
+        latencies.append(time.perf_counter() - t0)
+        if resp.status_code >= 500:
+            raise RuntimeError("{} {} -> {}".format(method, url, resp.status_code))
+    total = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(requests),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "throughput_rps": round(len(requests) / total, 1),
+        "sheets_calls": sum(fake.calls.values()) - calls_before,
+    }
+
+def traced_peak_kib(client, requests):
+    tracemalloc.start()
+    try:
+        for method, url, body in requests:
+            client.open(url, method=method, json=body)
+        return round(tracemalloc.get_traced_memory()[1] / 1024.0, 1)
+    finally:
+        tracemalloc.stop()
+
+def order_payload(i):
+    return {"id": 900000000 + i, "status": "processing", "date_created": "2026-10-01T10:00:00",
+            "billing": {"first_name": "Bench", "last_name": str(i), "country": "IT", "postcode": "20121", "city": "Milano"},
+            "shipping_lines": [{"method_title": "International Air Express"}], "total": "49.90"}
+
+def prefill_sqlite(app_module, fake):
+    from storage import SQLITE_COLUMNS
+    conn = sqlite3.connect(app_module.LOCAL_DB_PATH)
+    with conn:
+        conn.executemany("INSERT INTO orders (tracking_id, {}) VALUES (?{})".format(
+            ", ".join(SQLITE_COLUMNS), ", ?" * len(SQLITE_COLUMNS)),
+            ([row[1].rsplit("/", 1)[-1]] + row for row in fake.rows[1:]))
+    conn.close()
+
+def bench_size(app_module, size, n_requests, latency, backend):
+    from fake_sheet import FakeWorksheet
+    from storage import LRUCache
+
+    t0 = time.perf_counter()
+    fake = FakeWorksheet.generate(size, latency=latency)
+    generate_s = time.perf_counter() - t0
+    ids = fake.tracking_ids()
+    app_module.timeline_cache = LRUCache(app_module.TIMELINE_CACHE_SIZE)
+    app_module.init_storage(fake)
+    if backend == "sqlite":
+        prefill_sqlite(app_module, fake)
+    client = app_module.app.test_client()
+    rnd = random.Random(size)
+
+    # First lookup pays for loading the index (Sheet backend)
+    t0 = time.perf_counter()
+    client.get("/api/track/" + ids[0])
+    cold_ms = (time.perf_counter() - t0) * 1000
+
+    scenarios = {
+        "webhook": [("POST", "/webhook", order_payload(size * 10 + i)) for i in range(n_requests)],
+        "api_track": [("GET", "/api/track/" + rnd.choice(ids), None) for _ in range(n_requests)],
+        "api_track_miss": [("GET", "/api/track/zz{:06d}".format(i), None) for i in range(n_requests)],
+    }
+    results = {"sheet_rows": size, "generate_s": round(generate_s, 2), "cold_lookup_ms": round(cold_ms, 1)}
+    for name, requests in scenarios.items():
+        stats = measure(client, fake, requests)
+        # Separate, smaller pass: tracemalloc slows every allocation down
+        if name == "webhook":
+            sample = [("POST", "/webhook", order_payload(size * 10 + n_requests + i)) for i in range(50)]
+        else:
+            sample = requests[:50]
+        stats["traced_peak_kib"] = traced_peak_kib(client, sample)
+        results[name] = stats
+    results["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    app_module.storage.close()
+    return results
+
+def compare(current, baseline):
+    regressions = []
+    for size, endpoints in current["results"].items():
+        base = baseline.get("results", {}).get(size)
+        if not base:
+            continue
+        for name, stats in endpoints.items():
+            if not isinstance(stats, dict) or name not in base:
+                continue
+            for metric in ("p50_ms", "p99_ms"):
+                old, new = base[name][metric], stats[metric]
+                ratio = new / old if old else 1.0
+                flag = "REGRESSION" if ratio > REGRESSION_RATIO else ""
+                print("{:>8} {:<15} {:<7} {:>9.3f} -> {:>9.3f} ms  x{:.2f} {}".format(size, name, metric, old, new, ratio, flag))
+                if flag:
+                    regressions.append((size, name, metric))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="comma-separated sheet sizes (rows)")
+    parser.add_argument("--requests", type=int, default=300, help="requests per endpoint and size")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per Sheets API call")
+    parser.add_argument("--backend", choices=["sheet", "sqlite"], default="sheet")
+    parser.add_argument("--save", help="write results as JSON (e.g. bench/baseline.json)")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="tracking-bench-")
+    os.environ.update({
+        "STORAGE_BACKEND": args.backend,
+        "SHEET_MIRROR": "0",
+        "SHEETS_WARMUP": "0",
+        "LOCAL_DB_PATH": os.path.join(workdir, "bench.db"),
+        # Flushes would otherwise land in the middle of the measured requests
+        "SHEET_FLUSH_INTERVAL": "3600",
+    })
+    import app as app_module
+
+    results = {}
+    for size in [int(s) for s in args.sizes.split(",")]:
+        app_module.LOCAL_DB_PATH = os.path.join(workdir, "bench-{}.db".format(size))
+        results[str(size)] = bench_size(app_module, size, args.requests, args.latency, args.backend)
+        r = results[str(size)]
+        print("rows={:>8}  cold lookup {:>9.1f} ms  max rss {:>7.1f} MB".format(size, r["cold_lookup_ms"], r["max_rss_mb"]))
+        for name in ("webhook", "api_track", "api_track_miss"):
+            s = r[name]
+            print("  {:<15} p50 {:>8.3f} ms  p99 {:>8.3f} ms  {:>8.1f} req/s  sheets calls {:>4}  peak {:>8.1f} KiB".format(
+                name, s["p50_ms"], s["p99_ms"], s["throughput_rps"], s["sheets_calls"], s["traced_peak_kib"]))
+
+    report = {
+        "config": {"backend": args.backend, "requests": args.requests, "latency_s": args.latency},
+        "environment": {"python": platform.python_version(), "machine": platform.machine(),
+                        "cpus": os.cpu_count(), "date": time.strftime("%Y-%m-%d")},
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
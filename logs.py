@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+# ---------- Config ----------
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "json" (one object per line) or "text" for local runs
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+# Records waiting for the writer thread; beyond this they are dropped, never blocking a request
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Fraction of webhook bodies captured in the logs (0 = never, 1 = all), and max bytes kept
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0"))
+LOG_PAYLOAD_MAX_BYTES = int(os.environ.get("LOG_PAYLOAD_MAX_BYTES", "4000"))
+
+def kv(**fields):
+    """Structured fields for a log call: log.info("msg", extra=kv(order_id=1))."""
+    return {"fields": fields}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".{:03d}Z".format(int(record.msecs)),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join("{}={!r}".format(k, v) for k, v in fields.items())
+        return line
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of raising."""
+
+    dropped = 0
+
+    def prepare(self, record):
+        # Only merge args into msg here; serialization happens on the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+_listener = None
+
+def setup_logging():
+    """Send the "tracking" loggers through a queue to a background stdout writer."""
+    global _listener
+    if _listener is not None:
+        return
+    out = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "text":
+        out.setFormatter(TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    else:
+        out.setFormatter(JsonFormatter())
+    q = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(q, out, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger("tracking")
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(DroppingQueueHandler(q))
+    root.propagate = False
+
+def payload_preview(payload_bytes, sample_rate=None):
+    """Body preview for the logs, or None when this request is not sampled."""
+    rate = LOG_PAYLOAD_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate <= 0 or (rate < 1 and random.random() >= rate):
+        return None
+    return payload_bytes[:LOG_PAYLOAD_MAX_BYTES].decode("utf-8", errors="replace")
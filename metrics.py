@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import logging
+import tempfile
+import weakref
+import threading
+from logs import kv
+
+# ---------- Config ----------
+# Workers of one gunicorn master share a directory (keyed by the master pid);
+# each writes its own snapshot there and /metrics sums them all
+METRICS_DIR = os.environ.get("METRICS_DIR") or os.path.join(tempfile.gettempdir(), "tracking-metrics-{}".format(os.getppid()))
+METRICS_FLUSH_EVERY = float(os.environ.get("METRICS_FLUSH_EVERY", "5"))
+# "0": nothing is counted, no snapshot files and no /metrics endpoint
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1").lower() in ("1", "true", "yes")
+
+log = logging.getLogger("tracking.metrics")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTER = "counter"
+HISTOGRAM = "histogram"
+
+DESCRIPTIONS = {
+    "http_request_duration_seconds": (HISTOGRAM, "Request latency by Flask endpoint."),
+    "webhook_ignored_total": (COUNTER, "Webhook deliveries ignored because of the order status."),
+    "webhook_duplicates_total": (COUNTER, "Webhook deliveries answered from the dedup store."),
+    "webhook_signature_failures_total": (COUNTER, "Webhook deliveries rejected by the signature check."),
+    "webhook_parse_failures_total": (COUNTER, "Webhook deliveries with an empty or unparseable body."),
+    "webhook_archived_total": (COUNTER, "Webhook status updates acknowledged for an archived month."),
+    "sheets_calls_total": (COUNTER, "Google Sheets API calls by gspread operation."),
+    "sheets_call_seconds_total": (COUNTER, "Seconds spent waiting on Google Sheets API calls."),
+    "sheets_call_errors_total": (COUNTER, "Failed Google Sheets API calls by operation and kind."),
+    "tracking_lookups_total": (COUNTER, "Tracking ID lookups against the index by result."),
+    "tracking_index_rows_read_total": (COUNTER, "Sheet rows read into the tracking index by refresh mode."),
+    "tracking_snapshot_write_seconds": (HISTOGRAM, "Time to write the shared tracking snapshot file."),
+}
+
+# ---------- Per-thread shards ----------
+class _ShardOwner:
+    """Lives in the thread-local: collected when its thread ends."""
+
+class Registry:
+    """Counters and histograms kept in one dict per thread.
+
+    The hot path only touches the calling thread's dict, so no lock is taken;
+    collect() merges all shards of the process. When a thread ends its shard
+    is folded into a retired total, so per-request threads do not pile up.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = {}
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            owner = self._local.owner = _ShardOwner()
+            weakref.finalize(owner, self._retire, shard)
+            with self._shards_lock:
+                self._shards[id(shard)] = shard
+        return shard
+
+    def _retire(self, shard):
+        with self._shards_lock:
+            self._shards.pop(id(shard), None)
+            merge_into(self._retired, list(shard.items()))
+
+    def inc(self, name, value=1.0, **labels):
+        key = (COUNTER, name, tuple(sorted(labels.items())))
+        shard = self._shard()
+        shard[key] = shard.get(key, 0.0) + value
+
+    def observe(self, name, value, **labels):
+        key = (HISTOGRAM, name, tuple(sorted(labels.items())))
+        shard = self._shard()
+        hist = shard.get(key)
+        if hist is None:
+            # One slot per bucket, one for +Inf, then the sum
+            hist = shard[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        hist[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        hist[-1] += value
+
+    def collect(self):
+        merged = {}
+        with self._shards_lock:
+            shards = list(self._shards.values())
+            merge_into(merged, list(self._retired.items()))
+        for shard in shards:
+            merge_into(merged, list(shard.items()))
+        return merged
+
+def merge_into(merged, items):
+    for key, value in items:
+        if key[0] == HISTOGRAM:
+            cur = merged.get(key)
+            merged[key] = list(value) if cur is None else [a + b for a, b in zip(cur, value)]
+        else:
+            merged[key] = merged.get(key, 0.0) + value
+
+def _disabled(*args, **labels):
+    pass
+
+registry = Registry()
+inc = registry.inc if METRICS_ENABLED else _disabled
+observe = registry.observe if METRICS_ENABLED else _disabled
+
+# ---------- Cross-worker snapshots ----------
+def snapshot_path(pid=None):
+    return os.path.join(METRICS_DIR, "worker-{}.json".format(pid or os.getpid()))
+
+def write_snapshot():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    items = [[kind, name, [list(l) for l in labels], value] for (kind, name, labels), value in registry.collect().items()]
+    tmp = snapshot_path() + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(items, f)
+    os.replace(tmp, snapshot_path())
+
+def read_snapshots():
+    merged = registry.collect()
+    own = os.path.basename(snapshot_path())
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return merged
+    for name in names:
+        if not name.endswith(".json") or name == own:
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                items = json.load(f)
+        except (OSError, ValueError):
+            continue
+        merge_into(merged, [((kind, metric, tuple(tuple(l) for l in labels)), value)
+                            for kind, metric, labels, value in items])
+    return merged
+
+def _snapshot_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_EVERY)
+        try:
+            write_snapshot()
+        except OSError as e:
+            log.warning("metrics snapshot failed", extra=kv(error=repr(e)))
+
+def start_snapshots():
+    threading.Thread(target=_snapshot_loop, name="metrics-snapshot", daemon=True).start()
+    atexit.register(write_snapshot)
+
+# ---------- Prometheus text format ----------
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = ('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+def _num(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+def render():
+    merged = read_snapshots()
+    lines = []
+    # The type recorded with each series wins; DESCRIPTIONS only adds the help text
+    kinds = {key[1]: key[0] for key in merged}
+    for name in sorted(set(kinds) | set(DESCRIPTIONS)):
+        declared, text = DESCRIPTIONS.get(name, (COUNTER, ""))
+        kind = kinds.get(name, declared)
+        lines.append("# HELP {} {}".format(name, text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for key in sorted(k for k in merged if k[1] == name):
+            value = merged[key]
+            labels = key[2]
+            if key[0] == HISTOGRAM:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(name, _labels(labels, [("le", bound)]), cumulative))
+                lines.append("{}_sum{} {}".format(name, _labels(labels), _num(value[-1])))
+                lines.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+            else:
+                lines.append("{}{} {}".format(name, _labels(labels), _num(value)))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,158 @@
+"""Compact, memory-mapped snapshot of the tracking rows.
+
+One process writes it, every gunicorn worker maps it read-only, so the
+pages live once in the OS page cache whatever the number of workers.
+Rows changed since the snapshot was written go to an append-only delta
+file (<path>.delta) until the next full rewrite.
+
+Layout (little endian):
+    header   magic, version, record count, ID width, next Sheet row, build time
+    columns  uint32 length + JSON list of the Sheet header
+    index    count x (ID padded with NUL to the ID width, uint64 offset, uint32 length), sorted by ID
+    records  each row as a compact JSON array of already typed values (numbers stay numbers)
+"""
+import os
+import json
+import mmap
+import time
+import struct
+
+MAGIC = b"TRKSNAP1"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIQd")
+COLUMNS_LEN = struct.Struct("<I")
+
+def _entry(id_width):
+    return struct.Struct("<{}sQI".format(id_width))
+
+def write(path, columns, records, next_row, built_at=None):
+    """Write records, an iterable of (tracking_id, fields), to path atomically (os.replace).
+
+    built_at (time.time()) defaults to now; pass the instant the data was taken.
+    """
+    items = sorted((tracking_id.encode("utf-8"),
+                    json.dumps(fields, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+                   for tracking_id, fields in records)
+    id_width = max((len(key) for key, _ in items), default=1)
+    entry = _entry(id_width)
+    cols = json.dumps(list(columns)).encode("utf-8")
+    offset = HEADER.size + COLUMNS_LEN.size + len(cols) + entry.size * len(items)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(items), id_width, next_row,
+                             time.time() if built_at is None else built_at))
+        f.write(COLUMNS_LEN.pack(len(cols)))
+        f.write(cols)
+        for key, blob in items:
+            f.write(entry.pack(key, offset, len(blob)))
+            offset += len(blob)
+        for _, blob in items:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(items)
+
+class Snapshot:
+    """Read-only view of a snapshot file; lookups binary-search the mapped index."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Identifies the file version: os.replace gives every snapshot a new inode
+        self.file_id = (stat.st_ino, stat.st_mtime_ns)
+        magic, version, self.count, self.id_width, self.next_row, self.built_at = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a tracking snapshot: " + path)
+        (cols_len,) = COLUMNS_LEN.unpack_from(self._map, HEADER.size)
+        cols_at = HEADER.size + COLUMNS_LEN.size
+        self.columns = json.loads(self._map[cols_at:cols_at + cols_len].decode("utf-8"))
+        self._entry = _entry(self.id_width)
+        self._index_at = cols_at + cols_len
+
+    def get(self, tracking_id):
+        """Values of the row for tracking_id (Sheet column order), or None."""
+        key = tracking_id.encode("utf-8")
+        if len(key) > self.id_width:
+            return None
+        key = key.ljust(self.id_width, b"\0")
+        m, width, size, base = self._map, self.id_width, self._entry.size, self._index_at
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            at = base + mid * size
+            probe = m[at:at + width]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                _, offset, length = self._entry.unpack_from(m, at)
+                return json.loads(m[offset:offset + length])
+        return None
+
+    def __len__(self):
+        return self.count
+
+# ---------- Delta segment ----------
+# JSON lines: {"base": built_at} first, then [stamp, tracking_id, values] per changed
+# row and {"next_row": n} after each batch. A delta only applies to the snapshot
+# whose build time it names
+
+def delta_path(path):
+    return path + ".delta"
+
+def start_delta(path, base_built_at):
+    """Replace the delta with an empty one for the snapshot built at base_built_at."""
+    tmp = "{}.{}.tmp".format(delta_path(path), os.getpid())
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"base": base_built_at}) + "\n")
+    os.replace(tmp, delta_path(path))
+
+def append_delta(path, stamp, records, next_row):
+    """Append records, an iterable of (tracking_id, values), taken at stamp (time.time())."""
+    lines = [json.dumps([stamp, tracking_id, values], ensure_ascii=False, separators=(",", ":"))
+             for tracking_id, values in records]
+    lines.append(json.dumps({"next_row": next_row}))
+    with open(delta_path(path), "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    return len(lines) - 1
+
+class DeltaReader:
+    """Reads the lines appended to a delta file since the last call."""
+
+    def __init__(self, path):
+        self.path = delta_path(path)
+        self.file_id = None
+        self.base = None
+        self._offset = 0
+
+    def read(self):
+        """(reset, entries): reset is True when the file was replaced since the last call.
+
+        Entries are the parsed complete lines; a line still being written is left for later.
+        """
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return False, []
+        with f:
+            stat = os.fstat(f.fileno())
+            reset = self.file_id != stat.st_ino
+            if reset:
+                self.file_id, self.base, self._offset = stat.st_ino, None, 0
+            if stat.st_size <= self._offset:
+                return reset, []
+            f.seek(self._offset)
+            data = f.read(stat.st_size - self._offset)
+        end = data.rfind(b"\n") + 1
+        self._offset += end
+        entries = []
+        for line in data[:end].splitlines():
+            entry = json.loads(line)
+            if isinstance(entry, dict) and "base" in entry:
+                self.base = entry["base"]
+            else:
+                entries.append(entry)
+        return reset, entries
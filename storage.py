@@ -0,0 +1,1489 @@
+import os
+import re
+import gzip
+import json
+import time
+import random
+import logging
+import fcntl
+import sqlite3
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import gspread
+from gspread.utils import numericise_all, rowcol_to_a1
+import metrics
+from logs import kv
+from snapshot import Snapshot, DeltaReader, append_delta, start_delta, write as write_snapshot
+
+log = logging.getLogger("tracking.storage")
+
+# ---------- Row layout ----------
+# Column order used by webhook when appending rows
+SHEET_COLUMNS = ["Order ID", "Tracking Link", "Created At", "Service", "Country", "City", "Postcode", "Customer", "Status", "Total"]
+
+def tracking_id_from_link(link):
+    if not isinstance(link, str) or not link:
+        return ""
+    return link.rstrip("/").rsplit("/", 1)[-1]
+
+def row_to_record(header, row):
+    # Same shape and value conversion as gspread's get_all_records()
+    row = [str(v) for v in row]
+    if len(row) < len(header):
+        row = row + [""] * (len(header) - len(row))
+    return dict(zip(header, numericise_all(row[:len(header)])))
+
+def update_sheet_row(sheet, row):
+    # Rewrite the row holding this tracking link; False when it is not in the Sheet
+    cell = sheet.find(row[1], in_column=2)
+    if cell is None:
+        return False
+    last_col = rowcol_to_a1(cell.row, len(row))
+    sheet.update(range_name="A{}:{}".format(cell.row, last_col), values=[row])
+    return True
+
+class LRUCache:
+    """Small thread-safe LRU map with a fixed number of entries."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+class SingleFlight:
+    """Coalesces concurrent calls sharing a key into one execution.
+
+    The first caller runs fn; callers arriving while it runs wait and get
+    the same result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+        if leader:
+            try:
+                call["result"] = fn()
+            except BaseException as e:
+                call["error"] = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call["done"].set()
+        else:
+            call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+def open_local_db(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    return conn
+
+# ---------- Sheets gateway (deadlines, circuit breaker) ----------
+# Worker threads running gspread calls, shared by all requests of this process
+SHEETS_POOL_SIZE = int(os.environ.get("SHEETS_POOL_SIZE", "4"))
+# Calls running or queued before new ones are rejected with 503
+SHEETS_MAX_PENDING = int(os.environ.get("SHEETS_MAX_PENDING", "16"))
+# Seconds a caller waits for a single gspread call
+SHEETS_CALL_TIMEOUT = float(os.environ.get("SHEETS_CALL_TIMEOUT", "10"))
+# Non-idempotent calls are exempt: a write given up on may still land, and a retry
+# would then add the rows twice. Their caller waits for the outcome, which the
+# client's HTTP timeout (SHEETS_HTTP_TIMEOUT) bounds
+SHEETS_WRITE_OPS = frozenset(("append_row", "append_rows", "update"))
+# Consecutive failures that open the breaker, and seconds it stays open
+SHEETS_BREAKER_FAILURES = int(os.environ.get("SHEETS_BREAKER_FAILURES", "5"))
+SHEETS_BREAKER_COOLDOWN = float(os.environ.get("SHEETS_BREAKER_COOLDOWN", "30"))
+
+class SheetsUnavailable(Exception):
+    """Google Sheets is overloaded, timing out or behind an open breaker."""
+
+    def __init__(self, message, retry_after=SHEETS_BREAKER_COOLDOWN):
+        super().__init__(message)
+        self.retry_after = max(int(retry_after), 1)
+
+class SheetsGateway:
+    """Worksheet proxy running every gspread call on a bounded pool.
+
+    Callers wait at most `timeout` seconds (writes: until done); after `max_failures` consecutive
+    errors the breaker opens and calls fail fast for `cooldown` seconds, then a
+    single trial call decides whether it closes again.
+    """
+
+    def __init__(self, sheet, pool_size=SHEETS_POOL_SIZE, max_pending=SHEETS_MAX_PENDING,
+                 timeout=SHEETS_CALL_TIMEOUT, max_failures=SHEETS_BREAKER_FAILURES,
+                 cooldown=SHEETS_BREAKER_COOLDOWN):
+        self.sheet = sheet
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="sheets")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._trial_running = False
+
+    def __getattr__(self, name):
+        # Only worksheet methods are proxied; resolving them happens on the pool,
+        # so a LazySheet gets opened under the same deadline as the call itself
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def _invoke(self, target, op, args, kwargs):
+        return getattr(target, op)(*args, **kwargs)
+
+    def bind(self, sheet):
+        """Proxy for another worksheet, sharing this pool, deadline and breaker."""
+        return BoundSheet(self, sheet)
+
+    def call(self, op, *args, **kwargs):
+        return self.call_on(self.sheet, op, *args, **kwargs)
+
+    def call_on(self, target, op, *args, **kwargs):
+        try:
+            self._before_call()
+        except SheetsUnavailable:
+            metrics.inc("sheets_call_errors_total", op=op, kind="circuit_open")
+            raise
+        if not self._slots.acquire(blocking=False):
+            self._after_call(None)
+            metrics.inc("sheets_call_errors_total", op=op, kind="rejected")
+            raise SheetsUnavailable("Sheets overloaded", retry_after=1)
+        try:
+            future = self._pool.submit(self._invoke, target, op, args, kwargs)
+        except RuntimeError:
+            # Interpreter exiting (atexit drain of the spool): the pool no longer
+            # accepts work, so run the call inline without a deadline
+            self._slots.release()
+            self._after_call(None)
+            metrics.inc("sheets_calls_total", op=op)
+            return self._invoke(target, op, args, kwargs)
+        except Exception:
+            self._slots.release()
+            self._after_call(None)
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        metrics.inc("sheets_calls_total", op=op)
+        started = time.perf_counter()
+        try:
+            result = future.result(timeout=None if op in SHEETS_WRITE_OPS else self.timeout)
+        except FutureTimeout:
+            self._after_call(False)
+            metrics.inc("sheets_call_errors_total", op=op, kind="timeout")
+            raise SheetsUnavailable("Sheets {} timed out after {}s".format(op, self.timeout))
+        except Exception:
+            self._after_call(False)
+            metrics.inc("sheets_call_errors_total", op=op, kind="error")
+            raise
+        finally:
+            metrics.inc("sheets_call_seconds_total", time.perf_counter() - started, op=op)
+        self._after_call(True)
+        return result
+
+    @property
+    def is_open(self):
+        return self._failures >= self.max_failures
+
+    def _before_call(self):
+        with self._lock:
+            if self._failures < self.max_failures:
+                return
+            remaining = self._open_until - time.monotonic()
+            if remaining > 0 or self._trial_running:
+                raise SheetsUnavailable("Sheets circuit open", retry_after=max(remaining, 1))
+            # Half-open: let this call through as the trial
+            self._trial_running = True
+
+    def _after_call(self, ok):
+        with self._lock:
+            self._trial_running = False
+            if ok is None:
+                return
+            if ok:
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= self.max_failures:
+                self._open_until = time.monotonic() + self.cooldown
+
+class BoundSheet:
+    """Worksheet whose calls go through an existing SheetsGateway."""
+
+    def __init__(self, gateway, sheet):
+        self.gateway = gateway
+        self.sheet = sheet
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.gateway.call_on(self.sheet, name, *args, **kwargs)
+
+class LazySheet:
+    """Worksheet opened on first use instead of at import time.
+
+    opener() does the auth + open_by_key round trips; it runs once per
+    process (retried on the next use if it fails).
+    """
+
+    def __init__(self, opener):
+        self._opener = opener
+        self._sheet = None
+        self._lock = threading.Lock()
+        self.opened_at = None
+        self.open_seconds = None
+
+    @property
+    def is_open(self):
+        return self._sheet is not None
+
+    def open(self):
+        if self._sheet is None:
+            with self._lock:
+                if self._sheet is None:
+                    started = time.monotonic()
+                    self._sheet = self._opener()
+                    self.open_seconds = time.monotonic() - started
+                    self.opened_at = time.time()
+        return self._sheet
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.open(), name)
+
+# ---------- Tracking index (exact ID -> row) ----------
+# Seconds before a lookup triggers an incremental sync of newly appended rows
+TRACK_INDEX_MAX_AGE = float(os.environ.get("TRACK_INDEX_MAX_AGE", "30"))
+# Seconds between full rebuilds (picks up edits/deletes made by hand in the Sheet).
+# Status updates made by other workers arrive with the next sync through the
+# UpdateJournal, which is local: workers on other hosts see them only at the rebuild
+TRACK_INDEX_REBUILD_EVERY = float(os.environ.get("TRACK_INDEX_REBUILD_EVERY", "3600"))
+# Minimum seconds between extra syncs triggered by unknown IDs
+TRACK_INDEX_MISS_INTERVAL = float(os.environ.get("TRACK_INDEX_MISS_INTERVAL", "2"))
+
+def link_column(header):
+    return next((i for i, h in enumerate(header) if "link" in str(h).lower()), 1)
+
+def rows_after(sheet, start, width):
+    """Rows from Sheet row `start` to the end, first `width` columns."""
+    last_col = rowcol_to_a1(1, width).rstrip("0123456789")
+    try:
+        return sheet.get("A{}:{}".format(start, last_col))
+    except gspread.exceptions.APIError as e:
+        # Range starts past the last row of the grid: nothing new yet
+        if "exceeds grid limits" not in str(e):
+            raise
+        return []
+
+def count_lookups(found):
+    misses = sum(1 for record in found.values() if record is None)
+    if misses:
+        metrics.inc("tracking_lookups_total", misses, result="miss")
+    if len(found) > misses:
+        metrics.inc("tracking_lookups_total", len(found) - misses, result="hit")
+
+class TrackingIndex:
+    """In-memory map tracking ID -> record, fed by incremental reads of the Sheet.
+
+    Records are dicts keyed by the Sheet header, like get_all_records() returns.
+    Syncs only read appended rows; with a journal (UpdateJournal) they also pick
+    up the rows other workers rewrote in place.
+    """
+
+    def __init__(self, sheet, max_age=TRACK_INDEX_MAX_AGE, rebuild_every=TRACK_INDEX_REBUILD_EVERY,
+                 miss_interval=TRACK_INDEX_MISS_INTERVAL, journal=None):
+        self.sheet = sheet
+        self.max_age = max_age
+        self.rebuild_every = rebuild_every
+        self.miss_interval = miss_interval
+        self.journal = journal
+        self._applied = 0
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._header = None
+        self._link_col = 1
+        self._next_row = 2
+        self._synced_at = 0.0
+        self._rebuilt_at = 0.0
+        self._flight = SingleFlight()
+        # Bumped whenever the map changes / on every full rebuild
+        self.version = 0
+        self.rebuilds = 0
+        # IDs changed since the owner last swapped in a new set (None: not tracked)
+        self.changed = None
+
+    @property
+    def loaded(self):
+        return self._header is not None
+
+    def lookup(self, unique_id):
+        return self.lookup_many([unique_id])[unique_id]
+
+    def lookup_many(self, unique_ids):
+        """Resolve several IDs against one refresh of the index; misses map to None.
+
+        Refreshes are single-flight: concurrent callers share one Sheet read.
+        If a routine refresh fails the last good snapshot is served.
+        """
+        if self._header is None:
+            self.refresh()
+        else:
+            try:
+                self.refresh()
+            except Exception as e:
+                log.warning("index refresh failed, serving snapshot", extra=kv(error=repr(e)))
+        by_id = self._by_id
+        found = {uid: by_id.get(uid) for uid in unique_ids}
+        if None in found.values() and time.monotonic() - self._synced_at > self.miss_interval:
+            # Rows may have been appended by another worker since the last sync
+            try:
+                self._refresh(full=False)
+            except Exception as e:
+                # Misses stay None, the IDs found are still answered
+                log.warning("index sync on miss failed", extra=kv(error=repr(e)))
+            by_id = self._by_id
+            found = {uid: by_id.get(uid) for uid in unique_ids}
+        count_lookups(found)
+        return found
+
+    def refresh(self, max_age=None):
+        """Load the Sheet on first use, then sync or rebuild when due."""
+        now = time.monotonic()
+        max_age = self.max_age if max_age is None else max_age
+        if self._header is None:
+            self._refresh(full=True)
+        elif now - self._rebuilt_at > self.rebuild_every or now - self._synced_at > max_age:
+            self._refresh(full=now - self._rebuilt_at > self.rebuild_every)
+
+    def _refresh(self, full):
+        def run():
+            with self._lock:
+                if full:
+                    self._rebuild()
+                else:
+                    self._sync()
+        self._flight.do("rebuild" if full else "sync", run)
+
+    def add(self, unique_id, row):
+        """Register a row this process just appended, without waiting for a sync."""
+        # No lock: a single dict store is atomic, and a refresh may be holding it on the network
+        record = self._by_id[unique_id] = row_to_record(self._header or SHEET_COLUMNS, row)
+        if self.changed is not None:
+            self.changed.add(unique_id)
+        self.version += 1
+        return record
+
+    def update(self, unique_id, row):
+        """Register a row this process rewrote in place."""
+        if self.journal is not None:
+            self.journal.put(unique_id, row)
+        return self.add(unique_id, row)
+
+    def rebuild(self):
+        self._refresh(full=True)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def export(self):
+        """(header, {id: record}, next Sheet row) as of now, for writing a snapshot."""
+        # dict.copy() is atomic under the GIL, add() may run meanwhile
+        return self._header or list(SHEET_COLUMNS), self._by_id.copy(), self._next_row
+
+    def _ingest(self, rows, by_id):
+        header = self._header
+        col = self._link_col
+        changed = self.changed
+        for row in rows:
+            uid = tracking_id_from_link(row[col]) if len(row) > col else ""
+            if uid:
+                by_id[uid] = row_to_record(header, row)
+                if changed is not None:
+                    changed.add(uid)
+
+    def _rebuild(self):
+        values = self.sheet.get_all_values()
+        header = values[0] if values else list(SHEET_COLUMNS)
+        self._header = header
+        self._link_col = link_column(header)
+        # Build aside and swap, so readers never see a half-filled map
+        by_id = {}
+        self._ingest(values[1:], by_id)
+        self._by_id = by_id
+        metrics.inc("tracking_index_rows_read_total", max(len(values) - 1, 0), mode="rebuild")
+        self._next_row = len(values) + 1 if values else 2
+        self._synced_at = self._rebuilt_at = time.monotonic()
+        self.version += 1
+        self.rebuilds += 1
+        if self.journal is not None:
+            # The Sheet may have been read before the spool flushed recent updates
+            self._applied = 0
+            self.journal.prune(time.time() - SNAPSHOT_UPDATES_KEEP)
+            self._apply_journal()
+
+    def _sync(self):
+        rows = rows_after(self.sheet, self._next_row, len(self._header))
+        self._ingest(rows, self._by_id)
+        metrics.inc("tracking_index_rows_read_total", len(rows), mode="sync")
+        self._next_row += len(rows)
+        self._synced_at = time.monotonic()
+        if rows:
+            self.version += 1
+        if self.journal is not None:
+            self._apply_journal()
+
+    def _apply_journal(self):
+        for entry_id, unique_id, row in self.journal.since(self._applied):
+            # Only rows of this Sheet: the journal is shared by every partition
+            if unique_id in self._by_id:
+                self.add(unique_id, row)
+            self._applied = entry_id
+
+# ---------- Shared snapshot (one refresher, every worker maps it) ----------
+# Seconds between snapshot publishes by the refresher (skipped when nothing changed)
+TRACK_SNAPSHOT_INTERVAL = float(os.environ.get("TRACK_SNAPSHOT_INTERVAL", "5"))
+# A publish appends the changed rows to the delta file; the snapshot is rewritten
+# in full (and the delta emptied) at most this often, or when the delta grows past
+# TRACK_SNAPSHOT_DELTA_MAX rows
+TRACK_SNAPSHOT_COMPACT_EVERY = float(os.environ.get("TRACK_SNAPSHOT_COMPACT_EVERY", "600"))
+TRACK_SNAPSHOT_DELTA_MAX = int(os.environ.get("TRACK_SNAPSHOT_DELTA_MAX", "20000"))
+# Seconds the warm-up waits for the first snapshot; requests answer 503 right away
+TRACK_SNAPSHOT_WAIT = float(os.environ.get("TRACK_SNAPSHOT_WAIT", "20"))
+# Seconds between stat() calls looking for a newer snapshot file
+SNAPSHOT_CHECK_EVERY = 1.0
+# Seconds an in-place update stays journaled: a full rebuild may read the Sheet
+# before the spool flushed it, so the recent ones are applied again
+SNAPSHOT_UPDATES_KEEP = 600
+
+class UpdateJournal:
+    """Rows rewritten in place (status changes) by any worker of this host.
+
+    Incremental syncs only read appended rows, so without this journal an
+    update would reach the other workers' indexes (or the snapshot) only at
+    the next full rebuild.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute("CREATE TABLE IF NOT EXISTS index_updates ("
+                             "id INTEGER PRIMARY KEY AUTOINCREMENT, tracking_id TEXT NOT NULL, row TEXT NOT NULL, "
+                             "at REAL NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = open_local_db(self.path)
+        return conn
+
+    def put(self, tracking_id, row):
+        self._conn().execute("INSERT INTO index_updates (tracking_id, row, at) VALUES (?, ?, ?)",
+                             (tracking_id, json.dumps(row), time.time()))
+
+    def since(self, after_id):
+        """(id, tracking_id, row) journaled after after_id, oldest first."""
+        cur = self._conn().execute("SELECT id, tracking_id, row FROM index_updates WHERE id > ? ORDER BY id",
+                                   (after_id,))
+        return [(entry_id, tracking_id, json.loads(row)) for entry_id, tracking_id, row in cur]
+
+    def prune(self, before):
+        self._conn().execute("DELETE FROM index_updates WHERE at < ?", (before,))
+
+class SnapshotIndex:
+    """TrackingIndex shared by all workers through a memory-mapped snapshot file.
+
+    The worker holding the flock on <path>.lock keeps a full TrackingIndex and
+    appends the rows that changed to <path>.delta, rewriting the snapshot only
+    now and then; when that worker exits the lock passes to another one. The
+    others map the file read-only, follow the delta and read from the Sheet
+    only the rows appended after it, on misses. In-place updates go through an
+    UpdateJournal (<path>.db) so the refresher picks them up.
+    """
+
+    def __init__(self, sheet, path, interval=TRACK_SNAPSHOT_INTERVAL, wait=TRACK_SNAPSHOT_WAIT,
+                 miss_interval=TRACK_INDEX_MISS_INTERVAL):
+        self.sheet = sheet
+        self.path = path
+        self.interval = interval
+        self.wait = wait
+        self.miss_interval = miss_interval
+        self.journal = UpdateJournal(path + ".db")
+        # Filled only while this process is the refresher
+        self.index = TrackingIndex(sheet, miss_interval=miss_interval)
+        self.index.changed = set()
+        self._lock_file = None
+        self._written = None
+        # time.time() the current snapshot file was built at (None: not written by us yet)
+        self._base_at = None
+        self._delta_rows = 0
+        self._applied = 0
+        self._rebuilds_seen = 0
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._delta_reader = DeltaReader(path)
+        # tracking ID -> values from the delta of the mapped snapshot
+        self._delta = {}
+        # tracking ID -> (time.time() of the write, record) for rows added or updated here,
+        # or read past the snapshot; dropped once a snapshot built later has them
+        self._recent = {}
+        self._tail_row = 2
+        self._tail_at = 0.0
+        self._flight = SingleFlight()
+        self._stop = threading.Event()
+        self._try_lock()
+        self._thread = threading.Thread(target=self._run, name="snapshot-refresher", daemon=True)
+        self._thread.start()
+
+    @property
+    def refresher(self):
+        return self._lock_file is not None
+
+    @property
+    def loaded(self):
+        return self.index.loaded if self.refresher else self._snapshot is not None
+
+    def lookup(self, unique_id):
+        return self.lookup_many([unique_id])[unique_id]
+
+    def lookup_many(self, unique_ids):
+        if self.refresher:
+            return self.index.lookup_many(unique_ids)
+        snapshot = self._current()
+        if snapshot is None:
+            # Became the refresher
+            return self.index.lookup_many(unique_ids)
+        found = self._resolve(snapshot, unique_ids)
+        if None in found.values() and time.monotonic() - self._tail_at > self.miss_interval:
+            # Rows may have been appended after the snapshot was written
+            try:
+                self._flight.do("tail", lambda: self._read_tail(snapshot))
+            except Exception as e:
+                log.warning("snapshot tail read failed", extra=kv(error=repr(e)))
+            found = self._resolve(snapshot, unique_ids)
+        count_lookups(found)
+        return found
+
+    def add(self, unique_id, row):
+        if self.refresher:
+            return self.index.add(unique_id, row)
+        columns = self._snapshot.columns if self._snapshot is not None else SHEET_COLUMNS
+        record = row_to_record(columns, row)
+        self._recent[unique_id] = (time.time(), record)
+        return record
+
+    def update(self, unique_id, row):
+        self.journal.put(unique_id, row)
+        return self.add(unique_id, row)
+
+    def rebuild(self):
+        # Warm-up: wait for the current snapshot, or build the index if this process writes it
+        if self.refresher or self._current(wait=self.wait) is None:
+            self.index.rebuild()
+
+    def close(self):
+        """Stop refreshing and release the lock, so another index (or worker) can take over."""
+        self._stop.set()
+        self._thread.join(timeout=self.interval + 1)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __len__(self):
+        if self.refresher:
+            return len(self.index)
+        return (len(self._snapshot) if self._snapshot is not None else 0) + len(self._delta) + len(self._recent)
+
+    def _resolve(self, snapshot, unique_ids):
+        found = {}
+        for uid in unique_ids:
+            recent = self._recent.get(uid)
+            if recent is not None:
+                found[uid] = recent[1]
+                continue
+            values = self._delta.get(uid)
+            if values is None:
+                values = snapshot.get(uid)
+            found[uid] = dict(zip(snapshot.columns, values)) if values is not None else None
+        return found
+
+    def _current(self, wait=0):
+        """The mapped snapshot, remapped when the refresher replaced the file.
+
+        Without a snapshot yet, waits up to wait seconds, then raises SheetsUnavailable.
+        """
+        now = time.monotonic()
+        if self._snapshot is None or now - self._checked_at > SNAPSHOT_CHECK_EVERY:
+            self._checked_at = now
+            self._flight.do("map", self._map)
+        deadline = now + wait
+        while self._snapshot is None and not self.refresher and time.monotonic() < deadline:
+            time.sleep(0.2)
+            self._flight.do("map", self._map)
+        if self.refresher:
+            return None
+        if self._snapshot is None:
+            raise SheetsUnavailable("Tracking snapshot not ready", retry_after=self.interval)
+        return self._snapshot
+
+    def _map(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        current = self._snapshot
+        if current is None or current.file_id != (stat.st_ino, stat.st_mtime_ns):
+            new = Snapshot(self.path)
+            # The old map is closed when the last reader drops it. A recent row is kept
+            # unless the new snapshot has it and was built after it was written
+            self._recent = {uid: recent for uid, recent in list(self._recent.items())
+                            if recent[0] >= new.built_at or new.get(uid) is None}
+            self._tail_row = new.next_row
+            self._delta = {}
+            # Read the delta again from the start, for the new snapshot
+            self._delta_reader = DeltaReader(self.path)
+            self._snapshot = current = new
+        self._follow_delta(current)
+
+    def _follow_delta(self, snapshot):
+        reset, entries = self._delta_reader.read()
+        if reset:
+            self._delta = {}
+        if self._delta_reader.base != snapshot.built_at:
+            # Left over from the previous snapshot, or the next one is being written
+            return
+        delta = self._delta
+        for entry in entries:
+            if isinstance(entry, dict):
+                self._tail_row = max(self._tail_row, entry["next_row"])
+                continue
+            stamp, uid, values = entry
+            delta[uid] = values
+            recent = self._recent.get(uid)
+            if recent is not None and recent[0] < stamp:
+                self._recent.pop(uid, None)
+
+    def _read_tail(self, snapshot):
+        start = self._tail_row
+        rows = rows_after(self.sheet, start, len(snapshot.columns))
+        col = link_column(snapshot.columns)
+        for row in rows:
+            uid = tracking_id_from_link(row[col]) if len(row) > col else ""
+            if uid and uid not in self._recent:
+                # Stamped as old: any later snapshot supersedes it
+                self._recent[uid] = (0.0, row_to_record(snapshot.columns, row))
+        metrics.inc("tracking_index_rows_read_total", len(rows), mode="tail")
+        if self._snapshot is snapshot:
+            self._tail_row = start + len(rows)
+        self._tail_at = time.monotonic()
+
+    def _try_lock(self):
+        if self._lock_file is None:
+            f = open(self.path + ".lock", "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+            # Held until close() or the process exits
+            self._lock_file = f
+            log.info("snapshot refresher", extra=kv(path=self.path, pid=os.getpid()))
+        return True
+
+    def _publish(self):
+        # Updates journaled before this instant are in the snapshot written below
+        built_at = time.time()
+        index = self.index
+        index.refresh(max_age=self.interval)
+        rebuilt = index.rebuilds != self._rebuilds_seen
+        if rebuilt:
+            # The rebuild read the Sheet, possibly before the spool flushed recent updates
+            self._rebuilds_seen = index.rebuilds
+            self._applied = 0
+        for entry_id, tracking_id, row in self.journal.since(self._applied):
+            index.add(tracking_id, row)
+            self._applied = entry_id
+        self.journal.prune(built_at - SNAPSHOT_UPDATES_KEEP)
+        version = index.version
+        if version == self._written:
+            return
+        # add() from request threads may land in the old set after the swap: those
+        # rows reach the delta with the next sync, or the next rewrite
+        changed, index.changed = index.changed, set()
+        header, by_id, next_row = index.export()
+        if (self._base_at is None or rebuilt or self._delta_rows + len(changed) > TRACK_SNAPSHOT_DELTA_MAX
+                or built_at - self._base_at > TRACK_SNAPSHOT_COMPACT_EVERY):
+            started = time.perf_counter()
+            count = write_snapshot(self.path, header,
+                                   ((uid, [record.get(h, "") for h in header]) for uid, record in by_id.items()),
+                                   next_row, built_at=built_at)
+            start_delta(self.path, built_at)
+            self._base_at = built_at
+            self._delta_rows = 0
+            seconds = time.perf_counter() - started
+            metrics.observe("tracking_snapshot_write_seconds", seconds)
+            log.debug("snapshot written", extra=kv(path=self.path, rows=count, seconds=round(seconds, 3)))
+        else:
+            self._delta_rows += append_delta(self.path, built_at,
+                                             ((uid, [by_id[uid].get(h, "") for h in header])
+                                              for uid in changed if uid in by_id),
+                                             next_row)
+        self._written = version
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._try_lock():
+                    self._publish()
+            except Exception as e:
+                log.warning("snapshot refresh failed", extra=kv(path=self.path, error=repr(e)))
+            self._stop.wait(self.interval)
+
+# ---------- Write-behind spool (local journal -> Sheet) ----------
+SHEET_FLUSH_INTERVAL = float(os.environ.get("SHEET_FLUSH_INTERVAL", "2"))
+SHEET_FLUSH_BATCH = int(os.environ.get("SHEET_FLUSH_BATCH", "200"))
+SHEET_FLUSH_MAX_BACKOFF = float(os.environ.get("SHEET_FLUSH_MAX_BACKOFF", "300"))
+# A batch claimed by a worker that died is retried after this many seconds
+SPOOL_CLAIM_TIMEOUT = 300
+
+class RowSpool:
+    """Append-only journal of rows not yet written to the Sheet.
+
+    Shared by all gunicorn workers through the SQLite file; a worker claims a
+    batch before flushing it so two flushers never push the same rows.
+    target is the worksheet title for partitioned storage (None: the default sheet).
+    """
+
+    def __init__(self, path, connect=None):
+        # connect: per-thread connection of the owner, to journal rows in its transactions
+        self.path = path
+        self._connect = connect
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS sheet_spool ("
+                     "id INTEGER PRIMARY KEY AUTOINCREMENT, tracking_id TEXT NOT NULL, row TEXT NOT NULL, "
+                     "claimed_by TEXT, claimed_at REAL, kind TEXT NOT NULL DEFAULT 'append', target TEXT)")
+        columns = [c[1] for c in conn.execute("PRAGMA table_info(sheet_spool)")]
+        if "kind" not in columns:
+            conn.execute("ALTER TABLE sheet_spool ADD COLUMN kind TEXT NOT NULL DEFAULT 'append'")
+        if "target" not in columns:
+            conn.execute("ALTER TABLE sheet_spool ADD COLUMN target TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS sheet_spool_tracking_id ON sheet_spool (tracking_id)")
+
+    def _conn(self):
+        if self._connect is not None:
+            return self._connect()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = open_local_db(self.path)
+        return conn
+
+    def put(self, tracking_id, row, kind="append", target=None):
+        self._conn().execute("INSERT INTO sheet_spool (tracking_id, row, kind, target) VALUES (?, ?, ?, ?)",
+                             (tracking_id, json.dumps(row), kind, target))
+
+    def put_many(self, items, target=None):
+        """Journal (tracking_id, row) appends in one transaction (the caller's, when one is open)."""
+        conn = self._conn()
+        own = not conn.in_transaction
+        if own:
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT INTO sheet_spool (tracking_id, row, kind, target) VALUES (?, ?, 'append', ?)",
+                             [(tracking_id, json.dumps(row), target) for tracking_id, row in items])
+            if own:
+                conn.execute("COMMIT")
+        except Exception:
+            if own:
+                conn.execute("ROLLBACK")
+            raise
+
+    def update(self, tracking_id, row, target=None):
+        # Rewrite a pending append in place; if it is already being flushed, queue an update
+        cur = self._conn().execute("UPDATE sheet_spool SET row = ? WHERE tracking_id = ? AND kind = 'append' "
+                                   "AND claimed_by IS NULL", (json.dumps(row), tracking_id))
+        if cur.rowcount == 0:
+            self.put(tracking_id, row, kind="update", target=target)
+
+    def find(self, tracking_id):
+        cur = self._conn().execute("SELECT row FROM sheet_spool WHERE tracking_id = ? ORDER BY id DESC LIMIT 1",
+                                   (tracking_id,))
+        hit = cur.fetchone()
+        return json.loads(hit[0]) if hit else None
+
+    def pending(self, target=None):
+        if target is None:
+            return self._conn().execute("SELECT COUNT(*) FROM sheet_spool").fetchone()[0]
+        return self._conn().execute("SELECT COUNT(*) FROM sheet_spool WHERE target = ?", (target,)).fetchone()[0]
+
+    def claim(self, limit):
+        owner = "{}:{}".format(os.getpid(), threading.get_ident())
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            batch = conn.execute("SELECT id, kind, target, row FROM sheet_spool WHERE claimed_by IS NULL "
+                                 "OR claimed_at < ? ORDER BY id LIMIT ?", (now - SPOOL_CLAIM_TIMEOUT, limit)).fetchall()
+            conn.executemany("UPDATE sheet_spool SET claimed_by = ?, claimed_at = ? WHERE id = ?",
+                             [(owner, now, entry[0]) for entry in batch])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [(i, kind, target, json.loads(row)) for i, kind, target, row in batch]
+
+    def ack(self, ids):
+        self._conn().executemany("DELETE FROM sheet_spool WHERE id = ?", [(i,) for i in ids])
+
+    def release(self, ids):
+        self._conn().executemany("UPDATE sheet_spool SET claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+                                 [(i,) for i in ids])
+
+class SheetFlusher(threading.Thread):
+    """Background thread draining a RowSpool into the Sheet with append_rows.
+
+    Rows with a target go to resolve(target), the worksheet of their partition.
+    """
+
+    def __init__(self, spool, sheet, interval=SHEET_FLUSH_INTERVAL, batch_size=SHEET_FLUSH_BATCH,
+                 max_backoff=SHEET_FLUSH_MAX_BACKOFF, resolve=None):
+        super().__init__(name="sheet-flusher", daemon=True)
+        self.spool = spool
+        self.sheet = sheet
+        self.resolve = resolve
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self._wake = threading.Event()
+        self._queued = 0
+
+    def notify(self, count=1):
+        # Flush early once a full batch is waiting instead of sitting out the interval
+        self._queued += count
+        if self._queued >= self.batch_size:
+            self._wake.set()
+
+    def flush_once(self):
+        batch = self.spool.claim(self.batch_size)
+        if not batch:
+            return 0
+        done = []
+        try:
+            # Keep journal order: consecutive appends to one sheet go out as one append_rows call
+            for (kind, target), group in itertools.groupby(batch, key=lambda entry: entry[1:3]):
+                group = list(group)
+                sheet = self.resolve(target) if self.resolve is not None else self.sheet
+                if kind == "update":
+                    for i, _, _, row in group:
+                        if not update_sheet_row(sheet, row):
+                            log.warning("spooled update skipped, row not in Sheet", extra=kv(tracking_link=row[1]))
+                        done.append(i)
+                else:
+                    sheet.append_rows([row for _, _, _, row in group])
+                    done.extend(entry[0] for entry in group)
+        except Exception:
+            self.spool.ack(done)
+            self.spool.release([entry[0] for entry in batch[len(done):]])
+            raise
+        self.spool.ack(done)
+        return len(done)
+
+    def drain(self):
+        while self.flush_once():
+            pass
+
+    def run(self):
+        failures = 0
+        delay = self.interval
+        while True:
+            self._wake.wait(delay)
+            self._wake.clear()
+            self._queued = 0
+            try:
+                flushed = self.flush_once()
+                failures = 0
+                delay = 0 if flushed >= self.batch_size else self.interval
+            except Exception as e:
+                failures += 1
+                delay = min(self.max_backoff, self.interval * 2 ** failures) * random.uniform(0.5, 1.0)
+                log.error("sheet flush failed", extra=kv(retry_in_s=round(delay, 1), failures=failures, error=repr(e)))
+
+# ---------- Webhook dedup (order_id -> tracking ID) ----------
+DEDUP_CACHE_SIZE = int(os.environ.get("DEDUP_CACHE_SIZE", "10000"))
+
+class OrderDedup:
+    """Remembers which tracking ID each order got and the hash of its last payload.
+
+    Hot entries live in a bounded in-memory LRU; the SQLite table is the
+    source of truth shared by all workers.
+    """
+
+    def __init__(self, path, cache_size=DEDUP_CACHE_SIZE):
+        self.path = path
+        self.cache = LRUCache(cache_size)
+        self._local = threading.local()
+        self._conn().execute("CREATE TABLE IF NOT EXISTS webhook_orders ("
+                             "order_id TEXT PRIMARY KEY, tracking_id TEXT NOT NULL, tracking_link TEXT NOT NULL, "
+                             "created_at TEXT NOT NULL, payload_hash TEXT NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = open_local_db(self.path)
+        return conn
+
+    def get(self, order_id):
+        """Return (tracking_id, tracking_link, created_at, payload_hash) or None."""
+        hit = self.cache.get(order_id)
+        if hit is None:
+            hit = self._conn().execute("SELECT tracking_id, tracking_link, created_at, payload_hash "
+                                       "FROM webhook_orders WHERE order_id = ?", (order_id,)).fetchone()
+            if hit is not None:
+                self.cache.put(order_id, hit)
+        return hit
+
+    def claim(self, order_id, tracking_id, tracking_link, created_at, payload_hash):
+        """Register a new order; returns the existing entry if another request got there first."""
+        entry = (tracking_id, tracking_link, created_at, payload_hash)
+        cur = self._conn().execute("INSERT OR IGNORE INTO webhook_orders "
+                                   "(order_id, tracking_id, tracking_link, created_at, payload_hash) "
+                                   "VALUES (?, ?, ?, ?, ?)", (order_id,) + entry)
+        if cur.rowcount == 0:
+            self.cache.pop(order_id)
+            return self.get(order_id)
+        self.cache.put(order_id, entry)
+        return None
+
+    def set_hash(self, order_id, payload_hash):
+        self._conn().execute("UPDATE webhook_orders SET payload_hash = ? WHERE order_id = ?", (payload_hash, order_id))
+        self.cache.pop(order_id)
+
+    def forget(self, order_id):
+        self._conn().execute("DELETE FROM webhook_orders WHERE order_id = ?", (order_id,))
+        self.cache.pop(order_id)
+
+# ---------- Paged reads (exports) ----------
+# Rows fetched per Sheets call when streaming a whole worksheet
+EXPORT_PAGE_ROWS = int(os.environ.get("EXPORT_PAGE_ROWS", "1000"))
+
+def iter_sheet_records(sheet, page_rows=EXPORT_PAGE_ROWS):
+    """Yield the records of a worksheet, reading page_rows rows per call."""
+    header = sheet.row_values(1)
+    if not header:
+        return
+    last_col = rowcol_to_a1(1, len(header)).rstrip("0123456789")
+    start = 2
+    while True:
+        try:
+            rows = sheet.get("A{}:{}{}".format(start, last_col, start + page_rows - 1))
+        except gspread.exceptions.APIError as e:
+            if "exceeds grid limits" not in str(e):
+                raise
+            return
+        if not rows:
+            return
+        for row in rows:
+            if any(row):
+                yield row_to_record(header, row)
+        # A short page is not the end: the API drops trailing empty rows of the range
+        start += page_rows
+
+# ---------- Storage backends ----------
+# All expose append(tracking_id, row), append_many([(tracking_id, row)]), update(tracking_id, row),
+# find(tracking_id) -> record or None, find_many(ids) -> {id: record or None},
+# iter_records(page_rows, since, until) -> records in write order,
+# warm_up(), is_ready() and close()
+# since/until (dates) only let a backend skip data that cannot match; callers still filter
+
+class SheetStorage:
+    """Google Sheet as the datastore, read through a TrackingIndex.
+
+    With a spool, writes are journaled locally and flushed in the background.
+    With snapshot_path the index is shared by all workers (SnapshotIndex);
+    otherwise each worker keeps its own, and journal_path (SQLite) lets them
+    share in-place updates.
+    """
+
+    def __init__(self, sheet, spool=None, snapshot_path=None, journal_path=None):
+        self.sheet = sheet
+        if snapshot_path:
+            self.index = SnapshotIndex(sheet, snapshot_path)
+        else:
+            self.index = TrackingIndex(sheet, journal=UpdateJournal(journal_path) if journal_path else None)
+        self.spool = spool
+        self.flusher = None
+        if spool is not None:
+            self.flusher = SheetFlusher(spool, sheet)
+            self.flusher.start()
+
+    def append(self, tracking_id, row):
+        if self.spool is not None:
+            self.spool.put(tracking_id, row)
+            self.flusher.notify()
+        else:
+            self.sheet.append_row(row)
+        self.index.add(tracking_id, row)
+
+    def append_many(self, items):
+        """Append (tracking_id, row) pairs; a single append_rows call without a spool."""
+        if self.spool is not None:
+            self.spool.put_many(items)
+            self.flusher.notify(len(items))
+        else:
+            self.sheet.append_rows([row for _, row in items])
+        for tracking_id, row in items:
+            self.index.add(tracking_id, row)
+
+    def update(self, tracking_id, row):
+        if self.spool is not None:
+            self.spool.update(tracking_id, row)
+            self.flusher.notify()
+        elif not update_sheet_row(self.sheet, row):
+            self.sheet.append_row(row)
+        self.index.update(tracking_id, row)
+
+    def find(self, tracking_id):
+        return self.find_many([tracking_id])[tracking_id]
+
+    def find_many(self, tracking_ids):
+        found = self.index.lookup_many(tracking_ids)
+        if self.spool is not None:
+            for tracking_id in [uid for uid, record in found.items() if not record]:
+                # Journaled by another worker but not flushed to the Sheet yet
+                row = self.spool.find(tracking_id)
+                if row:
+                    found[tracking_id] = self.index.add(tracking_id, row)
+        return found
+
+    def iter_records(self, page_rows=EXPORT_PAGE_ROWS, since=None, until=None):
+        # Rows still in the spool are left out until flushed
+        return iter_sheet_records(self.sheet, page_rows)
+
+    def warm_up(self):
+        self.index.rebuild()
+
+    def is_ready(self):
+        return self.index.loaded
+
+    def close(self):
+        if self.flusher is not None:
+            self.flusher.drain()
+        if isinstance(self.index, SnapshotIndex):
+            self.index.close()
+
+# ---------- Monthly partitions ----------
+# Partitioned tracking IDs are "<yymm>-<hex>": the prefix names the worksheet
+# ("orders-YYYY-MM") holding the row, so a lookup loads that month only.
+# The month is the one the row was first written in, not the order date
+# Partition indexes kept in memory (most recently used months)
+PARTITION_INDEXES = int(os.environ.get("PARTITION_INDEXES", "3"))
+# Where archived months are written (gzip'd JSON lines, header first)
+SHEET_ARCHIVE_DIR = os.environ.get("SHEET_ARCHIVE_DIR", "archive")
+
+_PARTITION_ID = re.compile(r"^(\d{2}(?:0[1-9]|1[0-2]))-[0-9a-f]+$")
+_PARTITION_TITLE = re.compile(r"^orders-20(\d{2})-(\d{2})$")
+
+class PartitionArchived(Exception):
+    """Write to a month that was moved to the archive (read-only)."""
+
+def partition_key(dt):
+    return dt.strftime("%y%m")
+
+def partition_of(tracking_id):
+    """Partition key encoded in a tracking ID; None for legacy IDs (first worksheet)."""
+    m = _PARTITION_ID.match(tracking_id)
+    return m.group(1) if m else None
+
+def partition_title(key):
+    return "orders-20{}-{}".format(key[:2], key[2:])
+
+def partition_from_title(title):
+    m = _PARTITION_TITLE.match(title)
+    return m.group(1) + m.group(2) if m else None
+
+def archive_path(directory, key):
+    return os.path.join(directory, partition_title(key) + ".jsonl.gz")
+
+class ArchiveSheet:
+    """Read-only worksheet backed by an archived month, for TrackingIndex."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_all_values(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def get(self, range_name=None):
+        # Archives never grow
+        return []
+
+    def iter_records(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            header = json.loads(next(f, "[]"))
+            for line in f:
+                yield row_to_record(header, json.loads(line))
+
+class PartitionedSheetStorage:
+    """Google Sheet split into one worksheet per month, each with its own TrackingIndex.
+
+    spreadsheet is a SheetsGateway over the gspread Spreadsheet. Legacy IDs
+    live in the first worksheet; months are created on first write and can be
+    moved to a local archive. Only the most recently used indexes stay in memory.
+    """
+
+    def __init__(self, spreadsheet, spool=None, archive_dir=SHEET_ARCHIVE_DIR, max_indexes=PARTITION_INDEXES,
+                 miss_interval=TRACK_INDEX_MISS_INTERVAL, journal_path=None):
+        self.spreadsheet = spreadsheet
+        self.spool = spool
+        # In-place updates shared with the other workers' indexes (see SheetStorage)
+        self.journal = UpdateJournal(journal_path) if journal_path else None
+        self.archive_dir = archive_dir
+        self.miss_interval = miss_interval
+        self.indexes = LRUCache(max_indexes)
+        self._worksheets = None
+        self._listed_at = 0.0
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.flusher = None
+        if spool is not None:
+            self.flusher = SheetFlusher(spool, None, resolve=lambda title: self.worksheet(title, create=True))
+            self.flusher.start()
+
+    def _list_worksheets(self, force=False):
+        # title -> gspread Worksheet in spreadsheet order; forced re-lists are rate-limited
+        if self._worksheets is None or (force and time.monotonic() - self._listed_at > self.miss_interval):
+            def run():
+                self._worksheets = {ws.title: ws for ws in self.spreadsheet.worksheets()}
+                self._listed_at = time.monotonic()
+            self._flight.do("list", run)
+        return self._worksheets
+
+    def worksheet(self, title, create=False):
+        """Worksheet by title (None: the first, legacy one) bound to the gateway, or None."""
+        worksheets = self._list_worksheets()
+        if title is None:
+            return self.spreadsheet.bind(next(iter(worksheets.values())))
+        if title not in worksheets:
+            worksheets = self._list_worksheets(force=True)
+        if title not in worksheets and create:
+            worksheets = self._create_worksheet(title)
+        ws = worksheets.get(title)
+        return self.spreadsheet.bind(ws) if ws is not None else None
+
+    def _create_worksheet(self, title):
+        with self._lock:
+            if title in self._worksheets:
+                return self._worksheets
+            try:
+                ws = self.spreadsheet.add_worksheet(title=title, rows=1, cols=len(SHEET_COLUMNS))
+            except gspread.exceptions.APIError as e:
+                # Another worker created it first
+                if "already exists" not in str(e):
+                    raise
+                self._listed_at = 0.0
+                return self._list_worksheets(force=True)
+            self.spreadsheet.bind(ws).update(range_name="A1:" + rowcol_to_a1(1, len(SHEET_COLUMNS)), values=[SHEET_COLUMNS])
+            self._worksheets = dict(self._worksheets, **{title: ws})
+            log.info("partition created", extra=kv(title=title))
+            return self._worksheets
+
+    def _archived(self, key):
+        return key is not None and os.path.exists(archive_path(self.archive_dir, key))
+
+    def _index(self, key, create=False):
+        index = self.indexes.get(key)
+        if index is not None:
+            return index
+        if self._archived(key):
+            sheet = ArchiveSheet(archive_path(self.archive_dir, key))
+        else:
+            sheet = self.worksheet(partition_title(key) if key else None, create=create)
+            if sheet is None:
+                return None
+        with self._lock:
+            index = self.indexes.get(key)
+            if index is None:
+                index = TrackingIndex(sheet, journal=self.journal)
+                self.indexes.put(key, index)
+        return index
+
+    def _target(self, tracking_id):
+        # (partition key, worksheet title); both None for legacy IDs
+        key = partition_of(tracking_id)
+        if self._archived(key):
+            # Archived months are read-only: the caller must not report the write as done
+            raise PartitionArchived("{} is archived, cannot write {}".format(partition_title(key), tracking_id))
+        return key, partition_title(key) if key else None
+
+    def append(self, tracking_id, row):
+        key, title = self._target(tracking_id)
+        if self.spool is not None:
+            self.spool.put(tracking_id, row, target=title)
+            self.flusher.notify()
+            index = self.indexes.get(key)
+        else:
+            index = self._index(key, create=True)
+            index.sheet.append_row(row)
+        if index is not None:
+            index.add(tracking_id, row)
+
+    def append_many(self, items):
+        """Append (tracking_id, row) pairs with one spool transaction or append_rows call per month."""
+        groups = {}
+        for tracking_id, row in items:
+            groups.setdefault(self._target(tracking_id), []).append((tracking_id, row))
+        for (key, title), group in groups.items():
+            if self.spool is not None:
+                self.spool.put_many(group, target=title)
+                self.flusher.notify(len(group))
+                index = self.indexes.get(key)
+            else:
+                index = self._index(key, create=True)
+                index.sheet.append_rows([row for _, row in group])
+            if index is not None:
+                for tracking_id, row in group:
+                    index.add(tracking_id, row)
+
+    def update(self, tracking_id, row):
+        key, title = self._target(tracking_id)
+        if self.spool is not None:
+            self.spool.update(tracking_id, row, target=title)
+            self.flusher.notify()
+            index = self.indexes.get(key)
+        else:
+            index = self._index(key, create=True)
+            if not update_sheet_row(index.sheet, row):
+                index.sheet.append_row(row)
+        if self.journal is not None:
+            # Even when this worker has no index of the month loaded
+            self.journal.put(tracking_id, row)
+        if index is not None:
+            index.add(tracking_id, row)
+
+    def find(self, tracking_id):
+        return self.find_many([tracking_id])[tracking_id]
+
+    def find_many(self, tracking_ids):
+        by_key = {}
+        for tracking_id in tracking_ids:
+            by_key.setdefault(partition_of(tracking_id), []).append(tracking_id)
+        found = {}
+        for key, ids in by_key.items():
+            index = self._index(key)
+            found.update(index.lookup_many(ids) if index is not None else dict.fromkeys(ids))
+        if self.spool is not None:
+            for tracking_id in [uid for uid, record in found.items() if not record]:
+                row = self.spool.find(tracking_id)
+                if row:
+                    index = self.indexes.get(partition_of(tracking_id))
+                    found[tracking_id] = index.add(tracking_id, row) if index is not None \
+                        else row_to_record(SHEET_COLUMNS, row)
+        return found
+
+    def partitions(self):
+        """Keys of the months that still have a worksheet, oldest first."""
+        return sorted(k for k in map(partition_from_title, self._list_worksheets()) if k)
+
+    def archived_partitions(self):
+        try:
+            names = os.listdir(self.archive_dir)
+        except OSError:
+            return []
+        suffix = ".jsonl.gz"
+        return sorted(k for k in (partition_from_title(n[:-len(suffix)]) for n in names if n.endswith(suffix)) if k)
+
+    def iter_records(self, page_rows=EXPORT_PAGE_ROWS, since=None, until=None):
+        # Legacy rows first, then month by month. A month holds the rows written in it,
+        # so orders created that month or earlier: only months before `since` are skipped
+        lowest = partition_key(since) if since else "0000"
+        yield from iter_sheet_records(self.worksheet(None), page_rows)
+        for key in sorted(set(self.partitions()) | set(self.archived_partitions())):
+            if key < lowest:
+                continue
+            if self._archived(key):
+                yield from ArchiveSheet(archive_path(self.archive_dir, key)).iter_records()
+            else:
+                sheet = self.worksheet(partition_title(key))
+                if sheet is not None:
+                    yield from iter_sheet_records(sheet, page_rows)
+
+    def archive(self, key):
+        """Move a month to <archive_dir>/orders-YYYY-MM.jsonl.gz and delete its worksheet.
+
+        Lookups of its IDs are then served from the file. Returns the rows archived.
+        """
+        title = partition_title(key)
+        if self.spool is not None and self.spool.pending(title):
+            raise Exception("{} still has rows in the spool, retry after the flush".format(title))
+        self._listed_at = 0.0
+        ws = self._list_worksheets(force=True).get(title)
+        if ws is None:
+            raise Exception("No worksheet named " + title)
+        values = self.spreadsheet.bind(ws).get_all_values()
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = archive_path(self.archive_dir, key)
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+            for row in values:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        os.replace(path + ".tmp", path)
+        self.spreadsheet.del_worksheet(ws)
+        with self._lock:
+            self._worksheets = {t: w for t, w in self._worksheets.items() if t != title}
+            self.indexes.pop(key)
+        log.info("partition archived", extra=kv(title=title, rows=max(len(values) - 1, 0), path=path))
+        return max(len(values) - 1, 0)
+
+    def warm_up(self):
+        self._list_worksheets()
+        index = self._index(time.strftime("%y%m", time.gmtime()))
+        if index is not None:
+            index.rebuild()
+
+    def is_ready(self):
+        return self._worksheets is not None
+
+    def close(self):
+        if self.flusher is not None:
+            self.flusher.drain()
+
+# Table columns, in SHEET_COLUMNS order
+SQLITE_COLUMNS = ["order_id", "tracking_link", "created_at", "service", "country", "city", "postcode", "customer", "status", "total"]
+
+class SqliteStorage:
+    """Local SQLite datastore (WAL, so gunicorn workers read concurrently).
+
+    With mirror_sheet, new rows are also copied to the Google Sheet by a
+    background SheetFlusher; the Sheet being slow or down never blocks requests.
+    """
+
+    def __init__(self, path, mirror_sheet=None):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS orders ("
+                     "id INTEGER PRIMARY KEY AUTOINCREMENT, tracking_id TEXT NOT NULL, "
+                     + ", ".join("{} TEXT NOT NULL DEFAULT ''".format(c) for c in SQLITE_COLUMNS) + ")")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS orders_tracking_id ON orders (tracking_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS orders_order_id ON orders (order_id)")
+        self.spool = None
+        self.flusher = None
+        if mirror_sheet is not None:
+            # Same connections: a row and its mirror entry commit together
+            self.spool = RowSpool(path, connect=self._conn)
+            self.flusher = SheetFlusher(self.spool, mirror_sheet)
+            self.flusher.start()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = open_local_db(self.path)
+        return conn
+
+    def _write(self, statements):
+        # orders and sheet_spool in one transaction: a crash never leaves a row unmirrored
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            statements(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def append(self, tracking_id, row):
+        def statements(conn):
+            conn.execute("INSERT INTO orders (tracking_id, {}) VALUES (?{})".format(
+                ", ".join(SQLITE_COLUMNS), ", ?" * len(SQLITE_COLUMNS)), [tracking_id] + [str(v) for v in row])
+            if self.spool is not None:
+                self.spool.put(tracking_id, row)
+        self._write(statements)
+        if self.spool is not None:
+            self.flusher.notify()
+
+    def append_many(self, items):
+        def statements(conn):
+            conn.executemany("INSERT INTO orders (tracking_id, {}) VALUES (?{})".format(
+                ", ".join(SQLITE_COLUMNS), ", ?" * len(SQLITE_COLUMNS)),
+                [[tracking_id] + [str(v) for v in row] for tracking_id, row in items])
+            if self.spool is not None:
+                self.spool.put_many(items)
+        self._write(statements)
+        if self.spool is not None:
+            self.flusher.notify(len(items))
+
+    def update(self, tracking_id, row):
+        def statements(conn):
+            conn.execute("UPDATE orders SET {} WHERE tracking_id = ?".format(
+                ", ".join("{} = ?".format(c) for c in SQLITE_COLUMNS)), [str(v) for v in row] + [tracking_id])
+            if self.spool is not None:
+                self.spool.update(tracking_id, row)
+        self._write(statements)
+        if self.spool is not None:
+            self.flusher.notify()
+
+    def find(self, tracking_id):
+        hit = self._conn().execute("SELECT {} FROM orders WHERE tracking_id = ?".format(", ".join(SQLITE_COLUMNS)),
+                                   (tracking_id,)).fetchone()
+        return row_to_record(SHEET_COLUMNS, hit) if hit else None
+
+    def find_many(self, tracking_ids):
+        found = dict.fromkeys(tracking_ids)
+        if found:
+            rows = self._conn().execute("SELECT tracking_id, {} FROM orders WHERE tracking_id IN ({})".format(
+                ", ".join(SQLITE_COLUMNS), ", ".join("?" * len(found))), list(found))
+            for row in rows:
+                found[row[0]] = row_to_record(SHEET_COLUMNS, row[1:])
+        return found
+
+    def iter_records(self, page_rows=EXPORT_PAGE_ROWS, since=None, until=None):
+        cur = self._conn().execute("SELECT {} FROM orders ORDER BY id".format(", ".join(SQLITE_COLUMNS)))
+        while True:
+            rows = cur.fetchmany(page_rows)
+            if not rows:
+                return
+            for row in rows:
+                yield row_to_record(SHEET_COLUMNS, row)
+
+    def warm_up(self):
+        if self.flusher is not None:
+            self.flusher.sheet.row_values(1)
+
+    def is_ready(self):
+        return True
+
+    def close(self):
+        if self.flusher is not None:
+            self.flusher.drain()
@@ -0,0 +1,172 @@
+import json
+import hmac
+import hashlib
+import base64
+import binascii
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+# ---------- JSON decoder (orjson when installed) ----------
+try:
+    import orjson
+
+    def json_loads(raw):
+        return orjson.loads(raw)
+except ImportError:
+    orjson = None
+
+    def json_loads(raw):
+        return json.loads(raw)
+
+# ---------- Body format detection ----------
+FORMAT_EMPTY = "empty"
+FORMAT_JSON = "json"
+FORMAT_FORM = "form"
+FORMAT_MULTIPART = "multipart"
+
+def detect_format(content_type, payload_bytes):
+    # WooCommerce sends JSON; forms only show up for the ping and old plugins
+    if not payload_bytes:
+        return FORMAT_EMPTY
+    if payload_bytes.lstrip()[:1] in (b"{", b"["):
+        return FORMAT_JSON
+    ct = (content_type or "").lower()
+    if "application/x-www-form-urlencoded" in ct:
+        return FORMAT_FORM
+    if "multipart/form-data" in ct:
+        return FORMAT_MULTIPART
+    return FORMAT_JSON
+
+def parse_form(payload_bytes):
+    form = {}
+    for k, v in parse_qsl(payload_bytes.decode("utf-8", errors="replace"), keep_blank_values=True):
+        # First value wins, like werkzeug's MultiDict.to_dict()
+        form.setdefault(k, v)
+    return form
+
+def form_to_data(form):
+    # Some plugins post the order as a single form field holding JSON
+    if not form:
+        return None
+    if len(form) == 1:
+        v = next(iter(form.values()))
+        try:
+            return json_loads(v)
+        except Exception:
+            return form
+    return form
+
+def decode_json(payload_bytes):
+    try:
+        return json_loads(payload_bytes)
+    except Exception:
+        return None
+
+def is_ping(form):
+    return bool(form) and ("webhook_id" in form or "webhook" in form)
+
+# ---------- Signature ----------
+def compute_sigs(secret, payload_bytes):
+    digest = hmac.new(secret.encode("utf-8"), payload_bytes, hashlib.sha256).digest()
+    b64 = base64.b64encode(digest).decode()
+    hexs = digest.hex()
+    return b64, hexs
+
+def decode_sig_header(header_sig):
+    # "sha256=<hex>", bare hex (64 chars) or base64 (WooCommerce default) -> raw digest
+    try:
+        if header_sig.startswith("sha256="):
+            return bytes.fromhex(header_sig[7:])
+        if len(header_sig) == 64:
+            return bytes.fromhex(header_sig)
+        return base64.b64decode(header_sig, validate=True)
+    except (ValueError, binascii.Error):
+        return None
+
+def verify_sig(secret, payload_bytes, header_sig):
+    if not secret:
+        return True
+    if not header_sig:
+        return False
+    given = decode_sig_header(header_sig)
+    if given is None:
+        return False
+    digest = hmac.new(secret.encode("utf-8"), payload_bytes, hashlib.sha256).digest()
+    return hmac.compare_digest(given, digest)
+
+# ---------- Order normalization (webhook and backfill) ----------
+# Orders in other states are acknowledged but not tracked
+ACCEPTED_STATUSES = ("processing", "completed", "paid")
+DEFAULT_SERVICE = "International Air Express"
+
+def safe_get(d, *keys, default=""):
+    cur = d or {}
+    for k in keys:
+        if isinstance(cur, dict):
+            cur = cur.get(k, {})
+        else:
+            return default
+    return cur if cur not in (None, {}) else default
+
+def parse_datetime_iso(s):
+    if not s:
+        return None
+    try:
+        s2 = s.rstrip("Z")
+        return datetime.fromisoformat(s2)
+    except Exception:
+        for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f"):
+            try:
+                return datetime.strptime(s, fmt)
+            except Exception:
+                continue
+    return None
+
+def order_status(data):
+    return (data.get("status") or "").lower()
+
+def normalize_order(data, now=None):
+    """Return (row, created datetime) for a WooCommerce order dict.
+
+    row is in Sheet column order (storage.SHEET_COLUMNS) with an empty
+    tracking link; the date is date_paid, date_completed or date_created,
+    first one that parses, else now.
+    """
+    chosen_dt = None
+    for cand in (data.get("date_paid"), data.get("date_completed"), data.get("date_created") or data.get("created_at")):
+        if cand:
+            parsed = parse_datetime_iso(cand)
+            if parsed:
+                chosen_dt = parsed
+                break
+    if not chosen_dt:
+        chosen_dt = now or datetime.utcnow()
+
+    order_id = str(data.get("id") or data.get("number") or safe_get(data, "order_key") or "")
+    billing = data.get("billing") or {}
+    shipping = data.get("shipping") or {}
+    if not shipping or not any(shipping.values()):
+        shipping = billing or {}
+
+    customer_name = (billing.get("first_name", "") + " " + billing.get("last_name", "")).strip()
+    city = shipping.get("city", "") or shipping.get("town", "") or ""
+    postcode = shipping.get("postcode", "") or shipping.get("zip", "") or ""
+    country = shipping.get("country", "") or ""
+    total = data.get("total") or data.get("order_total") or ""
+
+    service = DEFAULT_SERVICE
+    shipping_lines = data.get("shipping_lines") or []
+    if isinstance(shipping_lines, list) and len(shipping_lines) > 0:
+        first = shipping_lines[0]
+        if isinstance(first, dict):
+            service = first.get("method_title") or first.get("name") or service
+        else:
+            service = str(first)
+
+    row = [order_id, "", chosen_dt.isoformat(), service, country, city, postcode, customer_name, order_status(data), total]
+    return row, chosen_dt
+
+def order_hash(row):
+    # created_at is left out: it falls back to "now" when the order has no dates.
+    # The link is hashed as empty whatever the row holds, as it was before an ID was assigned
+    return hashlib.sha1(json.dumps([row[0], ""] + list(row[3:])).encode("utf-8")).hexdigest()